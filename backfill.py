@@ -0,0 +1,351 @@
+import argparse
+import asyncio
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import aiohttp
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+import fingerprints
+import noaa_stations
+import rollups
+import tide_predictions
+import windy_async
+import windy_bbox
+from windy_bbox import WaterLevelsDb
+
+
+# Longest window the CO-OPS API serves in one request for each product
+CHUNK_DAYS = {
+    'water_level': 31,
+    'hourly_height': 365,
+    'high_low': 365,
+}
+CONCURRENCY = 8
+MAX_ATTEMPTS = 5
+RETRY_DELAY = 30  # seconds before retrying a failed unit, doubled per attempt
+WORK_DB = 'backfill.sqlite'
+DATE_FORMAT = "%Y%m%d %H:%M"
+# The only CO-OPS error meaning the window is simply empty
+NO_DATA_MESSAGE = "No data was found"
+
+
+def open_db():
+    my_engine = windy_bbox.open_db()
+    DeclarativeBase.metadata.create_all(my_engine)
+    return my_engine
+
+
+DeclarativeBase = declarative_base()
+
+
+class HistoryLevelsDb(DeclarativeBase):
+    __tablename__ = 'history_levels'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    product = Column('product', String(16), primary_key=True)
+    date_time = Column('date_time', DateTime, primary_key=True)
+    water_level = Column('water_level', Float)
+    hi_lo = Column('hi_lo', String(2))
+
+    def __repr__(self):
+        return "<HistoryLevel {} {} {}>".format(
+            self.station_id, self.product, self.date_time)
+
+
+def open_work_db(path=WORK_DB):
+    """Local SQLite table of (station, product, window) work units."""
+    work_db = sqlite3.connect(path)
+    work_db.execute(
+        "CREATE TABLE IF NOT EXISTS work_units ("
+        " station_id INTEGER NOT NULL,"
+        " product TEXT NOT NULL,"
+        " begin_date TEXT NOT NULL,"
+        " end_date TEXT NOT NULL,"
+        " status TEXT NOT NULL DEFAULT 'pending',"
+        " attempts INTEGER NOT NULL DEFAULT 0,"
+        " rows INTEGER,"
+        " error TEXT,"
+        " PRIMARY KEY (station_id, product, begin_date))"
+    )
+    work_db.commit()
+    return work_db
+
+
+def plan_work_units(work_db, stations_list, products, begin, end):
+    """Split the requested history into API-sized windows, once."""
+    units = []
+    for product in products:
+        chunk = timedelta(days=CHUNK_DAYS[product])
+        chunk_begin = begin
+        while chunk_begin < end:
+            chunk_end = min(chunk_begin + chunk, end)
+            for station_id in stations_list:
+                units.append((
+                    station_id,
+                    product,
+                    chunk_begin.strftime(DATE_FORMAT),
+                    # the API end date is inclusive
+                    (chunk_end - timedelta(minutes=1)).strftime(DATE_FORMAT),
+                ))
+            chunk_begin = chunk_end
+
+    work_db.executemany(
+        "INSERT OR IGNORE INTO work_units"
+        " (station_id, product, begin_date, end_date) VALUES (?, ?, ?, ?)",
+        units,
+    )
+    work_db.commit()
+
+
+def resume_work_units(work_db):
+    """
+    Put units left running by a killed job back in the queue and return
+    every unit still to do, oldest windows first.
+    """
+    work_db.execute(
+        "UPDATE work_units SET status = 'pending' WHERE status = 'running'")
+    work_db.commit()
+    return work_db.execute(
+        "SELECT station_id, product, begin_date, end_date FROM work_units"
+        " WHERE status = 'pending'"
+        " OR (status = 'failed' AND attempts < ?)"
+        " ORDER BY begin_date, product, station_id",
+        (MAX_ATTEMPTS,),
+    ).fetchall()
+
+
+def count_work_units(work_db):
+    return dict(work_db.execute(
+        "SELECT status, COUNT(*) FROM work_units GROUP BY status").fetchall())
+
+
+def exhausted_work_units(work_db):
+    """Failed units out of attempts, the gaps left in the history."""
+    return work_db.execute(
+        "SELECT station_id, product, begin_date, end_date, error"
+        " FROM work_units WHERE status = 'failed' AND attempts >= ?"
+        " ORDER BY begin_date, product, station_id",
+        (MAX_ATTEMPTS,),
+    ).fetchall()
+
+
+def mark_work_unit(work_db, unit, status, rows=None, error=None):
+    station_id, product, begin_date, _ = unit
+    work_db.execute(
+        "UPDATE work_units SET status = ?, rows = ?, error = ?,"
+        " attempts = attempts + ?"
+        " WHERE station_id = ? AND product = ? AND begin_date = ?",
+        (status, rows, error, 1 if status == 'running' else 0,
+         station_id, product, begin_date),
+    )
+    work_db.commit()
+
+
+def work_unit_attempts(work_db, unit):
+    station_id, product, begin_date, _ = unit
+    return work_db.execute(
+        "SELECT attempts FROM work_units"
+        " WHERE station_id = ? AND product = ? AND begin_date = ?",
+        (station_id, product, begin_date),
+    ).fetchone()[0]
+
+
+def parse_history_rows(json_dict):
+    """(date_time, value, hi_lo) rows of a CO-OPS water level payload."""
+    rows = []
+    for record in json_dict.get('data', []):
+        if record.get('v', '') == '':
+            continue
+        rows.append((
+            datetime.strptime(record['t'], "%Y-%m-%d %H:%M"),
+            float(record['v']),
+            record.get('ty', '').strip() or None,
+        ))
+    return rows
+
+
+def put_history_to_db(Session, station_id, product, begin, end, rows):
+    """
+    Store one work unit. Writes are idempotent, so a unit interrupted
+    after writing is simply redone on resume.
+    """
+    session_db = Session()
+    try:
+        if product == 'water_level':
+            # Verified levels replace the preliminary ones in water_levels
+            measures = {(station_id, t): v for t, v, _ in rows}
+            revised = []
+            new_rows = fingerprints.write_changed_rows(
+                session_db, WaterLevelsDb, 'water_level', measures, revised)
+            session_db.commit()
+            rollups.update_rollups(
+                session_db, WaterLevelsDb, 'water_level', 'water_level',
+                new_rows, revised)
+        else:
+            session_db.query(HistoryLevelsDb).filter(
+                HistoryLevelsDb.station_id == station_id,
+                HistoryLevelsDb.product == product,
+                HistoryLevelsDb.date_time >= begin,
+                HistoryLevelsDb.date_time <= end,
+            ).delete(synchronize_session=False)
+            session_db.bulk_insert_mappings(HistoryLevelsDb, [
+                {
+                    'station_id': station_id,
+                    'product': product,
+                    'date_time': t,
+                    'water_level': v,
+                    'hi_lo': hi_lo,
+                }
+                for t, v, hi_lo in rows
+            ])
+            session_db.commit()
+    finally:
+        session_db.close()
+
+
+class Progress:
+    """Throughput and ETA of the units processed by this run."""
+
+    def __init__(self, total, every=10):
+        self.total = total
+        self.every = every
+        self.done = 0
+        self.failed = 0
+        self.rows = 0
+        self.started = time.monotonic()
+
+    def update(self, rows=0, failed=False):
+        self.done += 1
+        self.failed += failed
+        self.rows += rows
+        if self.done % self.every == 0 or self.done == self.total:
+            self.report()
+
+    def report(self):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else float('inf')
+        print('{}/{} units ({} failed), {:.2f} units/s, {:.0f} rows/s, '
+              'ETA {}'.format(
+                  self.done, self.total, self.failed, rate,
+                  self.rows / elapsed, timedelta(seconds=int(eta))))
+
+
+async def run_work_unit(http, Session, db_executor, work_db, unit, datum):
+    """Fetch and store one unit, return its row count or None if it failed."""
+    station_id, product, begin_date, end_date = unit
+    mark_work_unit(work_db, unit, 'running')
+    base_url = noaa_stations.build_base_url(
+        begin_date, end_date, product=product, datum=datum)
+    url = windy_async.build_station_url(base_url, station_id)
+    try:
+        async with http.get(url) as resp:
+            resp.raise_for_status()
+            json_dict = await resp.json(content_type=None)
+        if 'error' in json_dict:
+            error = json_dict['error']
+            message = error.get('message', '') if isinstance(error, dict) else str(error)
+            if not message.startswith(NO_DATA_MESSAGE):
+                raise ValueError(message or 'Error retrieving data')
+            # No data for the window is a result, not a failure
+            rows = []
+        else:
+            rows = parse_history_rows(json_dict)
+        await asyncio.get_running_loop().run_in_executor(
+            db_executor, put_history_to_db, Session, station_id, product,
+            datetime.strptime(begin_date, DATE_FORMAT),
+            datetime.strptime(end_date, DATE_FORMAT), rows)
+    except Exception as error:
+        mark_work_unit(work_db, unit, 'failed', error=repr(error)[:500])
+        return None
+    mark_work_unit(work_db, unit, 'done', rows=len(rows))
+    return len(rows)
+
+
+async def run_backfill(work_db, Session, datum="MLLW", concurrency=CONCURRENCY):
+    """
+    Run the remaining work units with at most `concurrency` requests.
+    Failed units go back in the queue after RETRY_DELAY, doubled after
+    each attempt, until they run out of MAX_ATTEMPTS.
+    """
+    units = resume_work_units(work_db)
+    progress = Progress(len(units))
+    print('{} work units to do, {}'.format(len(units), count_work_units(work_db)))
+
+    queue = asyncio.Queue()
+    for unit in units:
+        queue.put_nowait(unit)
+
+    # A single writer thread keeps database writes serialized
+    db_executor = ThreadPoolExecutor(max_workers=1)
+
+    async def retry(unit, delay):
+        await asyncio.sleep(delay)
+        queue.put_nowait(unit)
+        # Only now, so queue.join() waits for the retry
+        queue.task_done()
+
+    async def worker():
+        while True:
+            unit = await queue.get()
+            rows = await run_work_unit(http, Session, db_executor, work_db,
+                                       unit, datum)
+            attempts = work_unit_attempts(work_db, unit)
+            if rows is None and attempts < MAX_ATTEMPTS:
+                retries.append(asyncio.ensure_future(
+                    retry(unit, RETRY_DELAY * 2 ** (attempts - 1))))
+                continue
+            progress.update(rows=rows or 0, failed=rows is None)
+            queue.task_done()
+
+    retries = []
+    timeout = aiohttp.ClientTimeout(total=300)
+    async with aiohttp.ClientSession(timeout=timeout) as http:
+        workers = [asyncio.ensure_future(worker()) for _ in range(concurrency)]
+        finished = asyncio.ensure_future(queue.join())
+        # A worker only returns early when it raised, do not wait forever
+        await asyncio.wait([finished, *workers],
+                           return_when=asyncio.FIRST_COMPLETED)
+        for task in [finished, *workers, *retries]:
+            task.cancel()
+        results = await asyncio.gather(*workers, finished, *retries,
+                                       return_exceptions=True)
+        for result in results[:len(workers)]:
+            if isinstance(result, Exception):
+                raise result
+    db_executor.shutdown()
+
+    print('finished: {}'.format(count_work_units(work_db)))
+    for station_id, product, begin_date, end_date, error in exhausted_work_units(work_db):
+        print('gap left after {} attempts: {} {} {} - {}: {}'.format(
+            MAX_ATTEMPTS, station_id, product, begin_date, end_date, error))
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Backfill multi-year water level history of all stations")
+    parser.add_argument('begin', help="first day, yyyymmdd")
+    parser.add_argument('end', help="day after the last one, yyyymmdd")
+    parser.add_argument('--products', nargs='+', default=['hourly_height'],
+                        choices=sorted(CHUNK_DAYS))
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    parser.add_argument('--work-db', default=WORK_DB)
+    args = parser.parse_args()
+
+    the_engine = open_db()
+    Session = sessionmaker(bind=the_engine)
+    stations = tide_predictions.get_stations_from_db(Session())
+
+    work = open_work_db(args.work_db)
+    plan_work_units(
+        work, stations, args.products,
+        datetime.strptime(args.begin, "%Y%m%d"),
+        datetime.strptime(args.end, "%Y%m%d"),
+    )
+    asyncio.run(run_backfill(work, Session, concurrency=args.concurrency))
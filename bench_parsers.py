@@ -0,0 +1,287 @@
+import argparse
+import fnmatch
+import gc
+import json
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+
+import noaa_stations
+import windy_bbox
+
+
+STATIONS_CSV = 'stations_import.csv'
+BEGIN = datetime(2022, 1, 28)
+M2_PERIOD_HOURS = 12.42  # principal lunar semidiurnal constituent
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+SLOWDOWN_THRESHOLD = 0.10
+MEMORY_THRESHOLD = 0.10
+
+
+def load_stations(n_stations):
+    """Station ids and coordinates from the import file, padded if needed."""
+    stations = pd.read_csv(STATIONS_CSV, sep=';', encoding='utf-8-sig')
+    ids = stations['station_id'].tolist()
+    # A few rows of the import file use a decimal comma
+    lats = stations['latitude'].astype(str).str.replace(',', '.').astype(float).tolist()
+    lons = stations['longitude'].astype(str).str.replace(',', '.').astype(float).tolist()
+    while len(ids) < n_stations:
+        i = len(ids)
+        ids.append(9900000 + i)
+        lats.append(lats[i % len(stations)])
+        lons.append(lons[i % len(stations)])
+    return ids[:n_stations], lats[:n_stations], lons[:n_stations]
+
+
+def _levels(rng, times_hours):
+    phase = rng.uniform(0, 2 * np.pi)
+    amplitude = rng.uniform(0.3, 2.5)
+    mean = rng.uniform(0.5, 3.0)
+    noise = rng.normal(0, 0.02, len(times_hours))
+    return mean + amplitude * np.cos(
+        2 * np.pi * times_hours / M2_PERIOD_HOURS + phase) + noise
+
+
+def _times(step_minutes, hours):
+    n = int(hours * 60 // step_minutes)
+    return [BEGIN + timedelta(minutes=step_minutes * i) for i in range(n)]
+
+
+def _extrema(rng, hours):
+    """Alternating high and low waters about every 6.21 hours."""
+    half_period = M2_PERIOD_HOURS / 2
+    start = rng.uniform(0, half_period)
+    times = np.arange(start, hours, half_period)
+    highs = (np.arange(len(times)) % 2) == 0
+    levels = np.where(highs, rng.uniform(2.0, 3.5, len(times)),
+                      rng.uniform(-0.3, 0.5, len(times)))
+    return [BEGIN + timedelta(hours=float(t)) for t in times], levels, highs
+
+
+def generate_json_payloads(product, station_ids, hours, interval=None, seed=0):
+    """
+    Deterministic CO-OPS JSON payloads, as windy_async.get_data_from_noaa
+    returns them, for every station over a window of the given hours.
+    """
+    rng = np.random.default_rng(seed)
+    payloads = []
+    for station_id in station_ids:
+        if product == 'predictions' and interval == 'hilo':
+            times, levels, highs = _extrema(rng, hours)
+            payload = {'predictions': [
+                {'t': t.strftime(TIME_FORMAT), 'v': '{:.3f}'.format(v),
+                 'type': 'H' if high else 'L'}
+                for t, v, high in zip(times, levels.tolist(), highs.tolist())
+            ]}
+        elif product == 'high_low':
+            times, levels, highs = _extrema(rng, hours)
+            # Highs alternate higher high / high, lows low / lower low
+            types = [('HH', 'H ')[i // 2 % 2] if high else ('LL', 'L ')[i // 2 % 2]
+                     for i, high in enumerate(highs.tolist())]
+            payload = {'data': [
+                {'t': t.strftime(TIME_FORMAT), 'v': '{:.3f}'.format(v),
+                 'ty': ty, 'f': '0,0'}
+                for t, v, ty in zip(times, levels.tolist(), types)
+            ]}
+        else:
+            step = 60 if product == 'hourly_height' else 6
+            times = _times(step, hours)
+            hours_since = np.arange(len(times)) * step / 60
+            levels = _levels(rng, hours_since).tolist()
+            if product == 'predictions':
+                payload = {'predictions': [
+                    {'t': t.strftime(TIME_FORMAT), 'v': '{:.3f}'.format(v)}
+                    for t, v in zip(times, levels)
+                ]}
+            else:
+                sigmas = rng.uniform(0, 0.01, len(times)).tolist()
+                record = {'f': '0,0,0,0'}
+                if product == 'water_level':
+                    record['q'] = 'p'
+                payload = {'data': [
+                    dict(record, t=t.strftime(TIME_FORMAT),
+                         v='{:.3f}'.format(v), s='{:.3f}'.format(s))
+                    for t, v, s in zip(times, levels, sigmas)
+                ]}
+        payload['metadata'] = {'id': str(station_id)}
+        payload['station_id'] = station_id
+        payloads.append(payload)
+    return payloads
+
+
+def generate_sos_csv(station_ids, lats, lons, hours, seed=0):
+    """Deterministic SOS bbox csv of 6-minute water levels of all stations."""
+    rng = np.random.default_rng(seed)
+    times = _times(6, hours)
+    hours_since = np.arange(len(times)) * 0.1
+    stamps = [t.strftime('%Y-%m-%dT%H:%M:%SZ') for t in times]
+    rows = ['station_id,sensor_id,"latitude (degree)","longitude (degree)",'
+            'date_time,"water_surface_height_above_reference_datum (m)",'
+            'datum_id,"vertical_position (m)"']
+    for station_id, lat, lon in zip(station_ids, lats, lons):
+        station = 'urn:ioos:station:NOAA.NOS.CO-OPS:{}'.format(station_id)
+        sensor = 'urn:ioos:sensor:NOAA.NOS.CO-OPS:{}:A1'.format(station_id)
+        for stamp, level in zip(stamps, _levels(rng, hours_since).tolist()):
+            rows.append('{},{},{},{},{},{:.3f},urn:ogc:def:datum:epsg::5103,'
+                        '0.000'.format(station, sensor, lat, lon, stamp, level))
+    return '\n'.join(rows) + '\n'
+
+
+def parse_json_payloads(payloads, product, interval=None):
+    """The parsing part of noaa_stations.get_data, without the network."""
+    frames = [noaa_stations.parse_station_json(p, product, interval)
+              for p in payloads]
+    return pd.concat([f for f in frames if not f.empty])
+
+
+def parse_sos_csv(tide_table):
+    """The row parsing part of windy_bbox.put_water_levels_to_db."""
+    measures = {}
+    station_measures = windy_bbox.group_measure_rows(tide_table.split('\n'))
+    for station_full, measure_rows in station_measures.items():
+        station_id = int(station_full.split(':')[-1])
+        for hour_rows in windy_bbox.group_rows_by_hour(measure_rows).values():
+            measures.update(windy_bbox.parse_measure_rows(station_id, hour_rows))
+    return measures
+
+
+def build_urls(station_ids):
+    return [noaa_stations.build_base_url(
+        (BEGIN + timedelta(hours=i)).strftime("%Y%m%d %H:%M"),
+        (BEGIN + timedelta(hours=i + 1)).strftime("%Y%m%d %H:%M"),
+        product="water_level",
+    ) for i in range(len(station_ids))]
+
+
+def make_cases(n_stations, hours, seed):
+    station_ids, lats, lons = load_stations(n_stations)
+    cases = {}
+    for product, interval in (('water_level', None), ('hourly_height', None),
+                              ('high_low', None), ('predictions', None),
+                              ('predictions', 'hilo')):
+        name = 'get_data[{}{}]'.format(
+            product, '-' + interval if interval else '')
+        payloads = generate_json_payloads(
+            product, station_ids, hours, interval, seed)
+        cases[name] = (parse_json_payloads, (payloads, product, interval))
+    cases['put_water_levels_to_db[parse]'] = (
+        parse_sos_csv, (generate_sos_csv(station_ids, lats, lons, hours, seed),))
+    cases['build_base_url'] = (build_urls, (station_ids,))
+    return cases
+
+
+def measure(func, args, repeat):
+    """
+    Median and best seconds per call, peak traced bytes during a call,
+    and the blocks and bytes the call allocated that its result holds.
+    """
+    func(*args)  # warm up caches and lazy imports
+    timings = []
+    for _ in range(repeat):
+        gc.collect()
+        started = time.perf_counter()
+        func(*args)
+        timings.append(time.perf_counter() - started)
+
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    # Every traced block was allocated by the call, the rest were freed
+    held = tracemalloc.take_snapshot().filter_traces(
+        [tracemalloc.Filter(False, tracemalloc.__file__)]).statistics('filename')
+    tracemalloc.stop()
+    del result
+
+    median = statistics.median(timings)
+    return {
+        'ops_per_sec': 1 / median,
+        'median_ms': median * 1000,
+        'best_ms': min(timings) * 1000,
+        'peak_kib': peak / 1024,
+        'held_kib': sum(stat.size for stat in held) / 1024,
+        'held_blocks': sum(stat.count for stat in held),
+    }
+
+
+def run(n_stations, hours, repeat, seed, only=None):
+    results = {}
+    for name, (func, args) in make_cases(n_stations, hours, seed).items():
+        if only and not fnmatch.fnmatch(name, only):
+            continue
+        results[name] = measure(func, args, repeat)
+        print('{:40} {:10.2f} ops/s {:10.2f} ms {:12.1f} KiB peak '
+              '{:12.1f} KiB in {:9d} blocks held'
+              .format(name, results[name]['ops_per_sec'],
+                      results[name]['median_ms'], results[name]['peak_kib'],
+                      results[name]['held_kib'], results[name]['held_blocks']))
+    return {
+        'config': {'stations': n_stations, 'hours': hours, 'repeat': repeat,
+                   'seed': seed, 'python': sys.version.split()[0],
+                   'numpy': np.__version__, 'pandas': pd.__version__},
+        'results': results,
+    }
+
+
+def compare(base, new, threshold=SLOWDOWN_THRESHOLD,
+            memory_threshold=MEMORY_THRESHOLD):
+    """
+    Print the change of every path and return the regressed ones. Speed
+    is compared on the best time, which is the least noisy of the repeats,
+    memory on the peak traced bytes of a call.
+    """
+    if base['config'] != new['config']:
+        print('warning: runs have different configs\n  {}\n  {}'.format(
+            base['config'], new['config']))
+    regressions = []
+    for name, new_result in new['results'].items():
+        base_result = base['results'].get(name)
+        if base_result is None:
+            print('{:40} new'.format(name))
+            continue
+        speed = base_result['best_ms'] / new_result['best_ms'] - 1
+        memory = (new_result['peak_kib'] / base_result['peak_kib'] - 1
+                  if base_result['peak_kib'] else 0.0)
+        flags = []
+        if speed < -threshold:
+            flags.append('SLOWDOWN')
+        if memory > memory_threshold:
+            flags.append('MEMORY')
+        if flags:
+            regressions.append(name)
+        print('{:40} {:+7.1%} ops/s {:+7.1%} peak memory{}'.format(
+            name, speed, memory, ''.join('  ' + flag for flag in flags)))
+    return regressions
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Micro-benchmarks of the NOAA payload parsers")
+    parser.add_argument('--stations', type=int, default=300)
+    parser.add_argument('--hours', type=float, default=24)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--only', help="glob of the paths to run")
+    parser.add_argument('--output', help="save the results to a json file")
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'),
+                        help="compare two saved runs instead of running")
+    parser.add_argument('--threshold', type=float, default=SLOWDOWN_THRESHOLD)
+    parser.add_argument('--memory-threshold', type=float, default=MEMORY_THRESHOLD)
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as base_file, open(args.compare[1]) as new_file:
+            regressions = compare(json.load(base_file), json.load(new_file),
+                                  args.threshold, args.memory_threshold)
+        sys.exit(1 if regressions else 0)
+
+    report = run(args.stations, args.hours, args.repeat, args.seed, args.only)
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(report, output, indent=2)
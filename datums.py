@@ -0,0 +1,179 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import aiohttp
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+import tide_predictions
+import windy_bbox
+
+
+DATUMS_URL = ("https://api.tidesandcurrents.noaa.gov/mdapi/prod/webapi/"
+              "stations/{}/datums.json?units=metric")
+DATUM_MAX_AGE = timedelta(days=90)  # datums change with a new tidal epoch
+CANONICAL_DATUM = "MLLW"  # datum and metric units of every stored series
+FEET_PER_METER = 1 / 0.3048
+CONC_REQ = 10
+NO_DATUMS = "NONE"  # datum name of the marker row of a station without datums
+
+
+def open_db():
+    my_engine = windy_bbox.open_db()
+    DeclarativeBase.metadata.create_all(my_engine)
+    return my_engine
+
+
+DeclarativeBase = declarative_base()
+
+
+class StationDatumDb(DeclarativeBase):
+    __tablename__ = 'station_datums'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    datum = Column('datum', String(16), primary_key=True)
+    value = Column('value', Float)  # meters above the station datum
+    fetched_at = Column('fetched_at', DateTime)
+
+    def __repr__(self):
+        return "<StationDatum {} {} {}>".format(
+            self.station_id, self.datum, self.value)
+
+
+async def get_datums_async(station_ids):
+    """
+    Datum table of every station, {station_id: {datum: meters}}, empty
+    for stations NOAA has no datums of. Stations failing with a network
+    or server error are left out and fetched again on the next refresh.
+    """
+    semaphore = asyncio.Semaphore(CONC_REQ)
+    datums = {}
+
+    async def get_station_datums(session, station_id):
+        try:
+            async with semaphore:
+                async with session.get(DATUMS_URL.format(station_id)) as resp:
+                    if resp.status == 404:
+                        datums[station_id] = {}
+                        return
+                    if resp.status != 200:
+                        print('datums of {}: HTTP {}'.format(station_id, resp.status))
+                        return
+                    datums_json = await resp.json(content_type=None)
+            datums[station_id] = {
+                datum['name']: float(datum['value'])
+                for datum in datums_json.get('datums') or []
+                if datum.get('value') is not None
+            }
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as error:
+            print('datums of {}: {}'.format(station_id, error))
+
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(
+            get_station_datums(session, station_id) for station_id in station_ids
+        ))
+    return datums
+
+
+def refresh_datums(session_db, station_ids, max_age=DATUM_MAX_AGE):
+    """
+    Fetch the datum tables of stations missing or older than max_age.
+    Stations without datums get a NO_DATUMS marker row, so they are not
+    fetched again before max_age either.
+    """
+    now = datetime.utcnow().replace(microsecond=0)
+    fresh = {station_id for station_id, in session_db.query(
+        StationDatumDb.station_id,
+    ).filter(StationDatumDb.fetched_at > now - max_age).distinct()}
+    stale = [s for s in station_ids if s not in fresh]
+    if not stale:
+        return 0
+
+    datums = asyncio.run(get_datums_async(stale))
+    session_db.query(StationDatumDb).filter(
+        StationDatumDb.station_id.in_(list(datums)),
+    ).delete(synchronize_session=False)
+    session_db.bulk_insert_mappings(StationDatumDb, [
+        {'station_id': station_id, 'datum': datum, 'value': value,
+         'fetched_at': now}
+        for station_id, station_datums in datums.items()
+        for datum, value in (station_datums or {NO_DATUMS: None}).items()
+    ])
+    session_db.commit()
+    return len(datums)
+
+
+def load_offsets(session_db, datum, from_datum=CANONICAL_DATUM):
+    """
+    Offsets in meters to add to levels referenced to from_datum to get
+    them referenced to datum, {station_id: offset}, None if no shift.
+    """
+    if datum == from_datum:
+        return None
+    values = {}
+    for station_id, name, value in session_db.query(
+            StationDatumDb.station_id, StationDatumDb.datum,
+            StationDatumDb.value,
+    ).filter(
+        StationDatumDb.datum.in_([datum, from_datum]),
+        StationDatumDb.value.isnot(None),
+    ):
+        values.setdefault(station_id, {})[name] = value
+    return {
+        station_id: station_datums[from_datum] - station_datums[datum]
+        for station_id, station_datums in values.items()
+        if datum in station_datums and from_datum in station_datums
+    }
+
+
+def unit_scale(units):
+    if units == "metric":
+        return 1.0
+    if units == "english":
+        return FEET_PER_METER
+    raise ValueError(
+        "Unknown units {}, use metric or english".format(units))
+
+
+def convert_levels(station_ids, values, offsets, units="metric"):
+    """
+    Shift canonical levels of the given stations by their datum offsets
+    and scale them to units in one vectorized step. Levels of stations
+    with no known offset become NaN.
+    """
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+    values = np.asarray(values, dtype=np.float64)
+    if offsets is None:
+        shift = np.zeros(values.shape)
+    else:
+        known = np.array(sorted(offsets), dtype=np.int64)
+        offset_values = np.array([offsets[s] for s in known.tolist()])
+        rank = np.searchsorted(known, station_ids)
+        rank = np.minimum(rank, max(len(known) - 1, 0))
+        shift = np.full(values.shape, np.nan)
+        if len(known):
+            found = known[rank] == station_ids
+            shift[found] = offset_values[rank[found]]
+    return (values + shift) * unit_scale(units)
+
+
+def convert_dataframe(df, offsets, value_column, units="metric"):
+    """Converted copy of a get_data-like dataframe with a station_id column."""
+    df = df.copy()
+    df[value_column] = convert_levels(
+        df['station_id'].astype(int).values, df[value_column].values,
+        offsets, units)
+    return df
+
+
+if __name__ == "__main__":
+
+    the_engine = open_db()
+    Session = sessionmaker(bind=the_engine)
+    session = Session()
+    stations = tide_predictions.get_stations_from_db(session)
+
+    print('{} station datum tables refreshed'.format(
+        refresh_datums(session, stations)))
@@ -0,0 +1,142 @@
+import hashlib
+from datetime import datetime
+
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+
+VALUE_DIGITS = 3  # NOAA reports levels with millimeter precision
+
+
+DeclarativeBase = declarative_base()
+
+
+class FingerprintDb(DeclarativeBase):
+    __tablename__ = 'payload_fingerprints'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    product = Column('product', String(16), primary_key=True)
+    window = Column('window', String(64), primary_key=True)
+    digest = Column('digest', String(40))
+    updated_at = Column('updated_at', DateTime)
+
+    def __repr__(self):
+        return "<Fingerprint {} {} {}>".format(
+            self.station_id, self.product, self.window)
+
+
+def payload_digest(payload):
+    """SHA-1 hex digest of a raw station payload, bytes or string."""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    return hashlib.sha1(payload).hexdigest()
+
+
+class FingerprintStore:
+    """
+    Content fingerprints of the station payloads of one product over a
+    set of request windows, used to skip payloads identical to the
+    stored ones. Windows are keys such as '20220128 00:00/20220203 00:00'
+    or the hours of the water level rows.
+
+    New digests are kept pending until commit(), which is called once
+    the changed rows are written, so a failed write is retried next run.
+    """
+
+    def __init__(self, session_db, product, windows):
+        if isinstance(windows, str):
+            windows = [windows]
+        self.session_db = session_db
+        self.product = product
+        self.windows = list(windows)
+        self.pending = {}
+        self.stored = {
+            (station_id, window): digest
+            for station_id, window, digest in session_db.query(
+                FingerprintDb.station_id, FingerprintDb.window,
+                FingerprintDb.digest,
+            ).filter(
+                FingerprintDb.product == product,
+                FingerprintDb.window.in_(self.windows),
+            )
+        }
+
+    def is_unchanged(self, station_id, digest, window=None):
+        if window is None:
+            window = self.windows[0]
+        return self.stored.get((int(station_id), window)) == digest
+
+    def remember(self, station_id, digest, window=None):
+        if window is None:
+            window = self.windows[0]
+        self.pending[(int(station_id), window)] = digest
+
+    def commit(self):
+        now = datetime.utcnow().replace(microsecond=0)
+        # Fingerprints of windows no longer requested can never match again
+        self.session_db.query(FingerprintDb).filter(
+            FingerprintDb.product == self.product,
+            FingerprintDb.window.notin_(self.windows),
+        ).delete(synchronize_session=False)
+        for (station_id, window), digest in self.pending.items():
+            self.session_db.merge(FingerprintDb(
+                station_id=station_id,
+                product=self.product,
+                window=window,
+                digest=digest,
+                updated_at=now,
+            ))
+        self.session_db.commit()
+        self.stored.update(self.pending)
+        self.pending = {}
+
+
+def write_changed_rows(session_db, model, value_column, incoming, revised=None):
+    """
+    Write {(station_id, date_time): value} rows, inserting missing rows
+    and updating rows whose value differs. Identical rows are left alone
+    and duplicated rows are dropped.
+
+    Returns the (station_id, date_time, value) rows actually written.
+    The (station_id, date_time) keys of updated rows are appended to the
+    revised list, when one is given.
+    """
+    if not incoming:
+        return []
+
+    station_ids = sorted({station_id for station_id, _ in incoming})
+    date_times = [date_time for _, date_time in incoming]
+    existing = {}
+    for stored in session_db.query(model).filter(
+            model.station_id.in_(station_ids),
+            model.date_time >= min(date_times),
+            model.date_time <= max(date_times),
+    ):
+        key = (stored.station_id, stored.date_time)
+        if key in existing:
+            session_db.delete(stored)
+        else:
+            existing[key] = stored
+
+    changed_rows = []
+    for (station_id, date_time), value in incoming.items():
+        stored = existing.get((station_id, date_time))
+        if stored is None:
+            # Добавляем запись
+            session_db.add(model(**{
+                'station_id': station_id,
+                'date_time': date_time,
+                value_column: value,
+            }))
+        else:
+            old_value = getattr(stored, value_column)
+            if (old_value is not None and value is not None
+                    and round(float(old_value), VALUE_DIGITS)
+                    == round(value, VALUE_DIGITS)):
+                continue
+            setattr(stored, value_column, value)
+            if revised is not None:
+                revised.append((station_id, date_time))
+        changed_rows.append((station_id, date_time, value))
+
+    return changed_rows
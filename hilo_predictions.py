@@ -0,0 +1,246 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, Float, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+import noaa_stations
+import fingerprints
+import tide_predictions
+from tide_predictions import PredictionsDb
+
+
+PREDICTION_DEPTH = 6  # days
+# Extra extrema on both sides so the window edges can be interpolated
+EXTREMA_MARGIN = timedelta(days=1)
+STEP = timedelta(minutes=6)
+
+
+def open_db():
+    my_engine = tide_predictions.open_db()
+    DeclarativeBase.metadata.create_all(my_engine)
+    return my_engine
+
+
+DeclarativeBase = declarative_base()
+
+
+class HiloPredictionsDb(DeclarativeBase):
+    __tablename__ = 'hilo_predictions'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    date_time = Column('date_time', DateTime, primary_key=True)
+    predicted_wl = Column('predicted_wl', Float)
+    hi_lo = Column('hi_lo', String(1))
+
+    def __repr__(self):
+        return "<HiloPrediction {} {} {}>".format(
+            self.station_id, self.date_time, self.hi_lo)
+
+
+def get_hilo_predictions_from_noaa(session_db, stations_list, today=None):
+    """Fetch high/low predictions of all stations and store them."""
+    if today is None:
+        today = datetime.utcnow().replace(
+            hour=0, minute=0, second=0, microsecond=0)
+    begin = today - EXTREMA_MARGIN
+    end = today + timedelta(days=PREDICTION_DEPTH) + EXTREMA_MARGIN
+    begin_date = begin.strftime("%Y%m%d %H:%M")
+    end_date = end.strftime("%Y%m%d %H:%M")
+    payloads = fingerprints.FingerprintStore(
+        session_db, 'predictions_hilo', '{}/{}'.format(begin_date, end_date))
+
+    hilo_by_stations = noaa_stations.get_data(
+        stations_list,
+        begin_date=begin_date,
+        end_date=end_date,
+        product="predictions",
+        datum="MLLW",
+        interval="hilo",
+        fingerprints=payloads,
+        )
+
+    put_hilo_predictions_to_db(session_db, hilo_by_stations, begin)
+    payloads.commit()
+
+
+def put_hilo_predictions_to_db(session_db, hilo_by_stations, window_begin):
+
+    session_db.query(HiloPredictionsDb).filter(
+        HiloPredictionsDb.date_time < window_begin,
+    ).delete(synchronize_session=False)
+
+    if hilo_by_stations.empty:
+        session_db.commit()
+        return
+
+    # A handful of extrema per day, so changed stations are simply rewritten
+    station_ids = hilo_by_stations['station_id'].astype(int).tolist()
+    session_db.query(HiloPredictionsDb).filter(
+        HiloPredictionsDb.station_id.in_(sorted(set(station_ids))),
+        HiloPredictionsDb.date_time >= window_begin,
+    ).delete(synchronize_session=False)
+    session_db.bulk_insert_mappings(HiloPredictionsDb, [
+        {
+            'station_id': station_id,
+            'date_time': date_time,
+            'predicted_wl': predicted_wl,
+            'hi_lo': hi_lo,
+        }
+        for station_id, date_time, predicted_wl, hi_lo in zip(
+            station_ids,
+            hilo_by_stations.index.to_pydatetime().tolist(),
+            hilo_by_stations['predicted_wl'].astype(float).tolist(),
+            hilo_by_stations['hi_lo'].tolist(),
+        )
+    ])
+    session_db.commit()
+
+
+def load_extrema(session_db, station_ids, begin, end):
+    """Stored extrema around [begin, end] as station, seconds, value arrays."""
+    rows = session_db.query(
+        HiloPredictionsDb.station_id, HiloPredictionsDb.date_time,
+        HiloPredictionsDb.predicted_wl,
+    ).filter(
+        HiloPredictionsDb.station_id.in_(list(station_ids)),
+        HiloPredictionsDb.date_time >= begin - EXTREMA_MARGIN,
+        HiloPredictionsDb.date_time <= end + EXTREMA_MARGIN,
+    ).all()
+    if not rows:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0))
+    ext_ids, date_times, values = zip(*rows)
+    return (np.array(ext_ids, dtype=np.int64),
+            np.array(date_times, dtype='datetime64[s]').astype(np.int64),
+            np.array(values, dtype=np.float64))
+
+
+def interpolate_extrema(ext_ids, ext_seconds, ext_values, station_ids, seconds):
+    """
+    Rebuild water levels at arbitrary (station_id, epoch seconds) points
+    from the high/low extrema of every station at once.
+
+    Between two consecutive extrema the tide is shaped as a half cosine,
+    which has zero slope at both extrema like the harmonic prediction.
+    Points outside the stored extrema of their station are NaN.
+    """
+    station_ids = np.asarray(station_ids, dtype=np.int64)
+    seconds = np.asarray(seconds, dtype=np.int64)
+    result = np.full(seconds.shape, np.nan)
+    if ext_ids.size < 2 or seconds.size == 0:
+        return result
+
+    order = np.lexsort((ext_seconds, ext_ids))
+    ext_ids = ext_ids[order]
+    ext_seconds = ext_seconds[order]
+    ext_values = ext_values[order]
+
+    # One sorted key space for all stations: station rank, then time
+    stations = np.unique(ext_ids)
+    origin = min(ext_seconds.min(), seconds.min())
+    span = max(ext_seconds.max(), seconds.max()) - origin + 1
+    ext_keys = np.searchsorted(stations, ext_ids) * span + (ext_seconds - origin)
+
+    rank = np.minimum(np.searchsorted(stations, station_ids), len(stations) - 1)
+    known = stations[rank] == station_ids
+    keys = rank * span + (seconds - origin)
+
+    right = np.searchsorted(ext_keys, keys, side='right')
+    left = right - 1
+    right = np.minimum(right, len(ext_keys) - 1)
+    left = np.maximum(left, 0)
+    inside = (known & (ext_ids[left] == station_ids)
+              & (ext_ids[right] == station_ids)
+              & (ext_seconds[left] <= seconds) & (ext_seconds[right] > seconds))
+
+    t0 = ext_seconds[left[inside]]
+    t1 = ext_seconds[right[inside]]
+    h0 = ext_values[left[inside]]
+    h1 = ext_values[right[inside]]
+    phase = (seconds[inside] - t0) / (t1 - t0)
+    result[inside] = (h0 + h1) / 2 + (h0 - h1) / 2 * np.cos(np.pi * phase)
+
+    # Points falling exactly on an extremum, including the last one
+    exact = known & (ext_ids[left] == station_ids) & (ext_seconds[left] == seconds)
+    result[exact] = ext_values[left[exact]]
+    return result
+
+
+def reconstruct_predictions(session_db, stations_list, begin, end, step=STEP):
+    """
+    Predictions of the stations between begin and end at the requested
+    step, shaped like noaa_stations.get_data output for "predictions".
+    """
+    ext_ids, ext_seconds, ext_values = load_extrema(
+        session_db, stations_list, begin, end)
+
+    times = np.arange(
+        np.datetime64(begin, 's'), np.datetime64(end, 's') + 1,
+        np.timedelta64(int(step.total_seconds()), 's'))
+    station_ids = np.repeat(np.asarray(stations_list, dtype=np.int64), len(times))
+    query_times = np.tile(times, len(stations_list))
+    values = interpolate_extrema(
+        ext_ids, ext_seconds, ext_values, station_ids,
+        query_times.astype(np.int64))
+
+    df = pd.DataFrame({
+        'station_id': station_ids,
+        'predicted_wl': values,
+    }, index=pd.DatetimeIndex(query_times, name='date_time'))
+    return df.dropna()
+
+
+def measure_error(session_db, begin, end):
+    """
+    Compare the reconstruction with the stored 6-minute predictions,
+    returning per-station RMSE, max absolute error and point counts.
+    """
+    rows = session_db.query(
+        PredictionsDb.station_id, PredictionsDb.date_time,
+        PredictionsDb.predicted_wl,
+    ).filter(
+        PredictionsDb.date_time >= begin, PredictionsDb.date_time <= end,
+    ).all()
+    if not rows:
+        return pd.DataFrame(columns=['rmse', 'max_abs_error', 'count'])
+
+    station_ids, date_times, values = zip(*rows)
+    station_ids = np.array(station_ids, dtype=np.int64)
+    seconds = np.array(date_times, dtype='datetime64[s]').astype(np.int64)
+    values = np.array([float(v) for v in values])
+
+    ext_ids, ext_seconds, ext_values = load_extrema(
+        session_db, np.unique(station_ids).tolist(), begin, end)
+    rebuilt = interpolate_extrema(
+        ext_ids, ext_seconds, ext_values, station_ids, seconds)
+
+    error = pd.DataFrame({
+        'station_id': station_ids,
+        'error': rebuilt - values,
+    }).dropna()
+    error['squared'] = error['error'] ** 2
+    error['abs'] = error['error'].abs()
+    stats = error.groupby('station_id').agg(
+        rmse=('squared', 'mean'),
+        max_abs_error=('abs', 'max'),
+        count=('error', 'size'),
+    )
+    stats['rmse'] = np.sqrt(stats['rmse'])
+    return stats
+
+
+if __name__ == "__main__":
+
+    the_engine = open_db()
+    Session = sessionmaker(bind=the_engine)
+    session = Session()
+    stations = tide_predictions.get_stations_from_db(session)
+
+    get_hilo_predictions_from_noaa(session, stations)
+
+    today = datetime.utcnow().replace(microsecond=0)
+    errors = measure_error(session, today, today + timedelta(days=PREDICTION_DEPTH))
+    print(errors.describe())
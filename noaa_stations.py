@@ -100,6 +100,10 @@ def build_base_url(
                 "format": "json",
             }
 
+        # Water level products like hourly_height and high_low need a datum
+        if datum is not None:
+            parameters["datum"] = datum
+
     # Build URL with requests library
     query_url = (
         requests.Request("GET", base_url, params=parameters).prepare().url
@@ -122,6 +126,226 @@ def _parse_known_date_formats(dt_string):
     )
 
 
+def parse_station_json(json_dict, product, interval=None):
+    """
+    Convert the JSON payload of one station, as returned by
+    windy_async.get_data_from_noaa, to a dataframe indexed by date_time.
+    An empty dataframe is returned when the payload has no data.
+    """
+    if product == "predictions":
+        key = "predictions"
+    else:
+        key = "data"
+
+    df = json_normalize(json_dict[key])  # Parse JSON dict to dataframe
+    if df.empty:
+        return df
+
+    # Rename output dataframe columns based on requested product
+    # and convert to useable data types
+    if product == "water_level":
+        # Rename columns for clarity
+        df.rename(
+            columns={
+                "f": "flags",
+                "q": "QC",
+                "s": "sigma",
+                "t": "date_time",
+                "v": "water_level",
+            },
+            inplace=True,
+        )
+
+        # Convert columns to numeric values
+        data_cols = df.columns.drop(["flags", "QC", "date_time"])
+        df[data_cols] = df[data_cols].apply(
+            pd.to_numeric, axis=1, errors="coerce"
+        )
+
+        # Convert date & time strings to datetime objects
+        df["date_time"] = pd.to_datetime(df["date_time"])
+
+    elif product == "hourly_height":
+        # Rename columns for clarity
+        df.rename(
+            columns={
+                "f": "flags",
+                "s": "sigma",
+                "t": "date_time",
+                "v": "water_level",
+            },
+            inplace=True,
+        )
+
+        # Convert columns to numeric values
+        data_cols = df.columns.drop(["flags", "date_time"])
+        df[data_cols] = df[data_cols].apply(
+            pd.to_numeric, axis=1, errors="coerce"
+        )
+
+        # Convert date & time strings to datetime objects
+        df["date_time"] = pd.to_datetime(df["date_time"])
+
+    elif product == "high_low":
+        # Rename columns for clarity
+        df.rename(
+            columns={
+                "f": "flags",
+                "ty": "high_low",
+                "t": "date_time",
+                "v": "water_level",
+            },
+            inplace=True,
+        )
+
+        # Separate to high and low dataframes
+        df_HH = df[df["high_low"] == "HH"].copy()
+        df_HH.rename(
+            columns={
+                "date_time": "date_time_HH",
+                "water_level": "HH_water_level",
+            },
+            inplace=True,
+        )
+
+        df_H = df[df["high_low"] == "H "].copy()
+        df_H.rename(
+            columns={
+                "date_time": "date_time_H",
+                "water_level": "H_water_level",
+            },
+            inplace=True,
+        )
+
+        df_L = df[df["high_low"].str.contains("L ")].copy()
+        df_L.rename(
+            columns={
+                "date_time": "date_time_L",
+                "water_level": "L_water_level",
+            },
+            inplace=True,
+        )
+
+        df_LL = df[df["high_low"].str.contains("LL")].copy()
+        df_LL.rename(
+            columns={
+                "date_time": "date_time_LL",
+                "water_level": "LL_water_level",
+            },
+            inplace=True,
+        )
+
+        # Extract dates (without time) for each entry
+        dates_HH = [
+            x.date() for x in pd.to_datetime(df_HH["date_time_HH"])
+        ]
+        dates_H = [x.date() for x in pd.to_datetime(df_H["date_time_H"])]
+        dates_L = [x.date() for x in pd.to_datetime(df_L["date_time_L"])]
+        dates_LL = [
+            x.date() for x in pd.to_datetime(df_LL["date_time_LL"])
+        ]
+
+        # Set indices to datetime
+        df_HH["date_time"] = dates_HH
+        df_HH.index = df_HH["date_time"]
+        df_H["date_time"] = dates_H
+        df_H.index = df_H["date_time"]
+        df_L["date_time"] = dates_L
+        df_L.index = df_L["date_time"]
+        df_LL["date_time"] = dates_LL
+        df_LL.index = df_LL["date_time"]
+
+        # Remove flags and combine to single dataframe
+        df_HH = df_HH.drop(columns=["flags", "high_low"])
+        df_H = df_H.drop(columns=["flags", "high_low", "date_time"])
+        df_L = df_L.drop(columns=["flags", "high_low", "date_time"])
+        df_LL = df_LL.drop(columns=["flags", "high_low", "date_time"])
+
+        # Keep only one instance per date (based on max/min)
+        maxes = df_HH.groupby(df_HH.index).HH_water_level.transform(max)
+        df_HH = df_HH.loc[df_HH.HH_water_level == maxes]
+        maxes = df_H.groupby(df_H.index).H_water_level.transform(max)
+        df_H = df_H.loc[df_H.H_water_level == maxes]
+        mins = df_L.groupby(df_L.index).L_water_level.transform(max)
+        df_L = df_L.loc[df_L.L_water_level == mins]
+        mins = df_LL.groupby(df_LL.index).LL_water_level.transform(max)
+        df_LL = df_LL.loc[df_LL.LL_water_level == mins]
+
+        df = df_HH.join(df_H, how="outer")
+        df = df.join(df_L, how="outer")
+        df = df.join(df_LL, how="outer")
+
+        # Convert columns to numeric values
+        data_cols = df.columns.drop(
+            [
+                "date_time",
+                "date_time_HH",
+                "date_time_H",
+                "date_time_L",
+                "date_time_LL",
+            ]
+        )
+        df[data_cols] = df[data_cols].apply(
+            pd.to_numeric, axis=1, errors="coerce"
+        )
+
+        # Convert date & time strings to datetime objects
+        df["date_time"] = pd.to_datetime(df.index)
+        df["date_time_HH"] = pd.to_datetime(df["date_time_HH"])
+        df["date_time_H"] = pd.to_datetime(df["date_time_H"])
+        df["date_time_L"] = pd.to_datetime(df["date_time_L"])
+        df["date_time_LL"] = pd.to_datetime(df["date_time_LL"])
+
+    elif product == "predictions":
+        if interval == "h" or interval is None:
+            # Rename columns for clarity
+            df.rename(
+                columns={"t": "date_time", "v": "predicted_wl"},
+                inplace=True,
+            )
+
+            # Convert columns to numeric values
+            data_cols = df.columns.drop(["date_time"])
+            df[data_cols] = df[data_cols].apply(
+                pd.to_numeric, axis=1, errors="coerce"
+            )
+
+        elif interval == "hilo":
+            # Rename columns for clarity
+            df.rename(
+                columns={
+                    "t": "date_time",
+                    "v": "predicted_wl",
+                    "type": "hi_lo",
+                },
+                inplace=True,
+            )
+
+            # Convert columns to numeric values
+            data_cols = df.columns.drop(["date_time", "hi_lo"])
+            df[data_cols] = df[data_cols].apply(
+                pd.to_numeric, axis=1, errors="coerce"
+            )
+
+        # Convert date & time strings to datetime objects
+        df["date_time"] = pd.to_datetime(df["date_time"])
+
+    # Set datetime to index (for use in resampling)
+    df.index = df["date_time"]
+    df = df.drop(columns=["date_time"])
+
+    # Handle hourly requests for water_level and currents data
+    if ((product == "water_level") | (product == "currents")) & (
+            interval == "h"
+    ):
+        df = df.resample("H").first()  # Only return the hourly data
+
+    df.drop_duplicates()  # Handle duplicates due to overlapping requests
+    df.insert(0, 'station_id', json_dict['station_id'])
+
+    return df
+
+
 def get_data(
         stations_list,
         begin_date,
@@ -132,6 +356,7 @@ def get_data(
         units="metric",
         time_zone="gmt",
         application='Eugene_Mamontov',
+        fingerprints=None,
 ):
     """
     Function to get data from NOAA CO-OPS API and convert it to a pandas
@@ -156,6 +381,8 @@ def get_data(
     interval -- the interval you would like data returned, string
     units -- units to be used for data output, string (default metric)
     time_zone -- time zone to be used for data output, string (default gmt)
+    fingerprints -- store of payload digests, stations with an unchanged
+                payload are skipped before parsing (default None)
     """
     # Convert dates to datetime objects so deltas can be calculated
     begin_datetime = _parse_known_date_formats(begin_date)
@@ -176,7 +403,17 @@ def get_data(
     #     )
 
     df_total = pd.DataFrame()  # Initialize an empty DataFrame
-    json_list = windy_async.get_data_from_noaa(begin_date, end_date, stations_list)
+    json_list = windy_async.get_data_from_noaa(
+        begin_date,
+        end_date,
+        stations_list,
+        product=product,
+        datum=datum,
+        interval=interval,
+        units=units,
+        time_zone=time_zone,
+        fingerprints=fingerprints,
+    )
     for json_dict in json_list:
         if "error" in json_dict:
             # raise ValueError(
@@ -187,217 +424,14 @@ def get_data(
         if json_dict == {}:
             continue
 
-        if product == "predictions":
-            key = "predictions"
-        else:
-            key = "data"
+        # Unchanged payloads were already skipped, remember the new digests
+        if fingerprints is not None:
+            fingerprints.remember(json_dict['station_id'], json_dict['digest'])
 
-        df = json_normalize(json_dict[key])  # Parse JSON dict to dataframe
+        df = parse_station_json(json_dict, product, interval)
         if df.empty:
             continue
 
-        # Rename output dataframe columns based on requested product
-        # and convert to useable data types
-        if product == "water_level":
-            # Rename columns for clarity
-            df.rename(
-                columns={
-                    "f": "flags",
-                    "q": "QC",
-                    "s": "sigma",
-                    "t": "date_time",
-                    "v": "water_level",
-                },
-                inplace=True,
-            )
-
-            # Convert columns to numeric values
-            data_cols = df.columns.drop(["flags", "QC", "date_time"])
-            df[data_cols] = df[data_cols].apply(
-                pd.to_numeric, axis=1, errors="coerce"
-            )
-
-            # Convert date & time strings to datetime objects
-            df["date_time"] = pd.to_datetime(df["date_time"])
-
-        elif product == "hourly_height":
-            # Rename columns for clarity
-            df.rename(
-                columns={
-                    "f": "flags",
-                    "s": "sigma",
-                    "t": "date_time",
-                    "v": "water_level",
-                },
-                inplace=True,
-            )
-
-            # Convert columns to numeric values
-            data_cols = df.columns.drop(["flags", "date_time"])
-            df[data_cols] = df[data_cols].apply(
-                pd.to_numeric, axis=1, errors="coerce"
-            )
-
-            # Convert date & time strings to datetime objects
-            df["date_time"] = pd.to_datetime(df["date_time"])
-
-        elif product == "high_low":
-            # Rename columns for clarity
-            df.rename(
-                columns={
-                    "f": "flags",
-                    "ty": "high_low",
-                    "t": "date_time",
-                    "v": "water_level",
-                },
-                inplace=True,
-            )
-
-            # Separate to high and low dataframes
-            df_HH = df[df["high_low"] == "HH"].copy()
-            df_HH.rename(
-                columns={
-                    "date_time": "date_time_HH",
-                    "water_level": "HH_water_level",
-                },
-                inplace=True,
-            )
-
-            df_H = df[df["high_low"] == "H "].copy()
-            df_H.rename(
-                columns={
-                    "date_time": "date_time_H",
-                    "water_level": "H_water_level",
-                },
-                inplace=True,
-            )
-
-            df_L = df[df["high_low"].str.contains("L ")].copy()
-            df_L.rename(
-                columns={
-                    "date_time": "date_time_L",
-                    "water_level": "L_water_level",
-                },
-                inplace=True,
-            )
-
-            df_LL = df[df["high_low"].str.contains("LL")].copy()
-            df_LL.rename(
-                columns={
-                    "date_time": "date_time_LL",
-                    "water_level": "LL_water_level",
-                },
-                inplace=True,
-            )
-
-            # Extract dates (without time) for each entry
-            dates_HH = [
-                x.date() for x in pd.to_datetime(df_HH["date_time_HH"])
-            ]
-            dates_H = [x.date() for x in pd.to_datetime(df_H["date_time_H"])]
-            dates_L = [x.date() for x in pd.to_datetime(df_L["date_time_L"])]
-            dates_LL = [
-                x.date() for x in pd.to_datetime(df_LL["date_time_LL"])
-            ]
-
-            # Set indices to datetime
-            df_HH["date_time"] = dates_HH
-            df_HH.index = df_HH["date_time"]
-            df_H["date_time"] = dates_H
-            df_H.index = df_H["date_time"]
-            df_L["date_time"] = dates_L
-            df_L.index = df_L["date_time"]
-            df_LL["date_time"] = dates_LL
-            df_LL.index = df_LL["date_time"]
-
-            # Remove flags and combine to single dataframe
-            df_HH = df_HH.drop(columns=["flags", "high_low"])
-            df_H = df_H.drop(columns=["flags", "high_low", "date_time"])
-            df_L = df_L.drop(columns=["flags", "high_low", "date_time"])
-            df_LL = df_LL.drop(columns=["flags", "high_low", "date_time"])
-
-            # Keep only one instance per date (based on max/min)
-            maxes = df_HH.groupby(df_HH.index).HH_water_level.transform(max)
-            df_HH = df_HH.loc[df_HH.HH_water_level == maxes]
-            maxes = df_H.groupby(df_H.index).H_water_level.transform(max)
-            df_H = df_H.loc[df_H.H_water_level == maxes]
-            mins = df_L.groupby(df_L.index).L_water_level.transform(max)
-            df_L = df_L.loc[df_L.L_water_level == mins]
-            mins = df_LL.groupby(df_LL.index).LL_water_level.transform(max)
-            df_LL = df_LL.loc[df_LL.LL_water_level == mins]
-
-            df = df_HH.join(df_H, how="outer")
-            df = df.join(df_L, how="outer")
-            df = df.join(df_LL, how="outer")
-
-            # Convert columns to numeric values
-            data_cols = df.columns.drop(
-                [
-                    "date_time",
-                    "date_time_HH",
-                    "date_time_H",
-                    "date_time_L",
-                    "date_time_LL",
-                ]
-            )
-            df[data_cols] = df[data_cols].apply(
-                pd.to_numeric, axis=1, errors="coerce"
-            )
-
-            # Convert date & time strings to datetime objects
-            df["date_time"] = pd.to_datetime(df.index)
-            df["date_time_HH"] = pd.to_datetime(df["date_time_HH"])
-            df["date_time_H"] = pd.to_datetime(df["date_time_H"])
-            df["date_time_L"] = pd.to_datetime(df["date_time_L"])
-            df["date_time_LL"] = pd.to_datetime(df["date_time_LL"])
-
-        elif product == "predictions":
-            if interval == "h" or interval is None:
-                # Rename columns for clarity
-                df.rename(
-                    columns={"t": "date_time", "v": "predicted_wl"},
-                    inplace=True,
-                )
-
-                # Convert columns to numeric values
-                data_cols = df.columns.drop(["date_time"])
-                df[data_cols] = df[data_cols].apply(
-                    pd.to_numeric, axis=1, errors="coerce"
-                )
-
-            elif interval == "hilo":
-                # Rename columns for clarity
-                df.rename(
-                    columns={
-                        "t": "date_time",
-                        "v": "predicted_wl",
-                        "type": "hi_lo",
-                    },
-                    inplace=True,
-                )
-
-                # Convert columns to numeric values
-                data_cols = df.columns.drop(["date_time", "hi_lo"])
-                df[data_cols] = df[data_cols].apply(
-                    pd.to_numeric, axis=1, errors="coerce"
-                )
-
-            # Convert date & time strings to datetime objects
-            df["date_time"] = pd.to_datetime(df["date_time"])
-
-        # Set datetime to index (for use in resampling)
-        df.index = df["date_time"]
-        df = df.drop(columns=["date_time"])
-
-        # Handle hourly requests for water_level and currents data
-        if ((product == "water_level") | (product == "currents")) & (
-                interval == "h"
-        ):
-            df = df.resample("H").first()  # Only return the hourly data
-
-        df.drop_duplicates()  # Handle duplicates due to overlapping requests
-        df.insert(0, 'station_id', json_dict['station_id'])
-
         df_total = pd.concat([df_total, df])
 
     return df_total
@@ -0,0 +1,399 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+import numpy as np
+from aiohttp import web
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+import datums
+import hilo_predictions
+import windy_bbox
+from fingerprints import FingerprintDb
+from hilo_predictions import HiloPredictionsDb
+from ticks import TICK_SECONDS
+from windy_bbox import StationDb, WaterLevelsDb
+from tide_predictions import PredictionsDb
+
+
+CACHE_SIZE = 4096
+LATEST_TTL = 15 * 60  # seconds, a few missed ingest cycles
+PREDICTIONS_TTL = 60 * 60
+STATIONS_TTL = 24 * 60 * 60
+DATUMS_TTL = 24 * 60 * 60
+INGEST_PERIOD = 6 * 60
+
+TIME_FORMAT = "%Y-%m-%d %H:%M"
+
+NO_DATA = object()  # cached for stations without observations
+
+
+class HotCache:
+    """
+    In-memory cache with LRU eviction and per-entry TTL.
+
+    It is only touched from the event loop, so no locking is needed.
+    """
+
+    def __init__(self, max_entries=CACHE_SIZE, ttl=LATEST_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._entries[key] = (expires_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def invalidate_kind(self, kind):
+        """Drop every (kind, ...) entry."""
+        for key in [k for k in self._entries
+                    if isinstance(k, tuple) and k[0] == kind]:
+            del self._entries[key]
+
+    def update_latest(self, new_rows):
+        """
+        Apply freshly ingested (station_id, date_time, value) rows in place.
+
+        A row replaces a cached latest only when it is newer. Stations
+        with no cached entry are returned instead, the batch may hold only
+        a revised older row while the database has a newer one.
+        """
+        newest = {}
+        for station_id, date_time, value in new_rows:
+            station_id = int(station_id)
+            if station_id not in newest or newest[station_id][0] < date_time:
+                newest[station_id] = (date_time, float(value))
+
+        unknown = []
+        for station_id, latest in newest.items():
+            key = ('latest', station_id)
+            current = self.get(key)
+            if current is None:
+                unknown.append(station_id)
+            elif current is NO_DATA or current[0] <= latest[0]:
+                self.put(key, latest)
+        return unknown
+
+
+def query_latest(session_db, station_ids=None):
+    """Latest observation of each station from the water_levels table."""
+    newest = session_db.query(
+        WaterLevelsDb.station_id,
+        func.max(WaterLevelsDb.date_time).label('date_time'),
+    ).group_by(WaterLevelsDb.station_id)
+    if station_ids is not None:
+        newest = newest.filter(WaterLevelsDb.station_id.in_(station_ids))
+    newest = newest.subquery()
+
+    rows = session_db.query(
+        WaterLevelsDb.station_id, WaterLevelsDb.date_time,
+        WaterLevelsDb.water_level,
+    ).join(
+        newest,
+        (WaterLevelsDb.station_id == newest.c.station_id)
+        & (WaterLevelsDb.date_time == newest.c.date_time),
+    ).all()
+    return [(s, d, float(v)) for s, d, v in rows if v is not None]
+
+
+def query_predictions(session_db, station_id):
+    """
+    Predictions of a station as sorted numpy arrays: the stored 6-minute
+    ones, extended on both sides with the curve rebuilt from the stored
+    high/low extrema, which reach further than the 6-minute window.
+    """
+    rows = session_db.query(
+        PredictionsDb.date_time, PredictionsDb.predicted_wl,
+    ).filter(
+        PredictionsDb.station_id == station_id,
+    ).order_by(PredictionsDb.date_time).all()
+    date_times = np.array([d for d, _ in rows], dtype='datetime64[s]')
+    values = np.array([float(v) for _, v in rows], dtype=np.float64)
+
+    first, last = session_db.query(
+        func.min(HiloPredictionsDb.date_time),
+        func.max(HiloPredictionsDb.date_time),
+    ).filter(HiloPredictionsDb.station_id == station_id).one()
+    if first is None:
+        return date_times, values
+    # Rebuild on the 6-minute grid of the stored predictions
+    seconds = np.datetime64(first, 's').astype(np.int64)
+    first = (-(-seconds // TICK_SECONDS) * TICK_SECONDS).astype('datetime64[s]')
+    rebuilt = hilo_predictions.reconstruct_predictions(
+        session_db, [station_id], first, last)
+    rebuilt_times = rebuilt.index.values.astype('datetime64[s]')
+    rebuilt_values = rebuilt['predicted_wl'].values
+    if len(date_times):
+        outside = (rebuilt_times < date_times[0]) | (rebuilt_times > date_times[-1])
+        rebuilt_times = rebuilt_times[outside]
+        rebuilt_values = rebuilt_values[outside]
+    date_times = np.concatenate([date_times, rebuilt_times])
+    values = np.concatenate([values, rebuilt_values])
+    order = np.argsort(date_times, kind='stable')
+    return date_times[order], values[order]
+
+
+def query_updated_predictions(session_db, since=None):
+    """
+    Stations whose predictions tide_predictions.py or extrema
+    hilo_predictions.py rewrote after since, and the newest rewrite time,
+    from the payload fingerprints they commit once the rows are stored.
+    """
+    query = session_db.query(
+        FingerprintDb.station_id, FingerprintDb.updated_at,
+    ).filter(FingerprintDb.product.in_(['predictions', 'predictions_hilo']))
+    if since is not None:
+        query = query.filter(FingerprintDb.updated_at > since)
+    rows = query.all()
+    return ({s for s, _ in rows}, max((u for _, u in rows), default=since))
+
+
+def query_stations(session_db):
+    rows = session_db.query(
+        StationDb.id, StationDb.station_name, StationDb.latitude,
+        StationDb.longitude,
+    ).all()
+    return {
+        'id': np.array([r[0] for r in rows], dtype=np.int64),
+        'name': [r[1] for r in rows],
+        'latitude': np.array([float(r[2]) for r in rows]),
+        'longitude': np.array([float(r[3]) for r in rows]),
+    }
+
+
+async def run_db(app, query, *args):
+    """Run a blocking query in the default executor with its own session."""
+    def call():
+        session_db = app['Session']()
+        try:
+            return query(session_db, *args)
+        finally:
+            session_db.close()
+
+    return await asyncio.get_running_loop().run_in_executor(None, call)
+
+
+async def get_conversion(request):
+    """
+    Datum offsets and units requested with the datum and units query
+    parameters. Stored levels are MLLW and metric, other datums are
+    converted locally from the cached station datum tables.
+    """
+    datum = request.query.get('datum', datums.CANONICAL_DATUM)
+    units = request.query.get('units', 'metric')
+    try:
+        datums.unit_scale(units)
+    except ValueError as error:
+        raise web.HTTPBadRequest(text=str(error))
+
+    if datum == datums.CANONICAL_DATUM:
+        return None, units
+    key = ('datum_offsets', datum)
+    offsets = request.app['cache'].get(key)
+    if offsets is None:
+        offsets = await run_db(request.app, datums.load_offsets, datum)
+        if not offsets:
+            # Not cached, the datum tables may still be on their way
+            raise web.HTTPBadRequest(
+                text="No station has datum {} in the datum tables".format(datum))
+        request.app['cache'].put(key, offsets, ttl=DATUMS_TTL)
+    return offsets, units
+
+
+def _levels_json(values):
+    return [None if np.isnan(v) else round(v, 3) for v in values.tolist()]
+
+
+async def handle_latest(request):
+    cache = request.app['cache']
+    stations = await get_stations(request.app)
+    station_ids = stations['id'].tolist()
+    if 'station_id' in request.match_info:
+        station_ids = [int(request.match_info['station_id'])]
+
+    found = {s: cache.get(('latest', s)) for s in station_ids}
+    missing = [s for s, latest in found.items() if latest is None]
+    if missing:
+        rows = await run_db(request.app, query_latest, missing)
+        for station_id, date_time, value in rows:
+            found[station_id] = (date_time, value)
+            cache.put(('latest', station_id), (date_time, value))
+        # Remember stations without data too, the ingest fills them in
+        for station_id in missing:
+            if found[station_id] is None:
+                cache.put(('latest', station_id), NO_DATA)
+
+    found = [(s, latest) for s, latest in found.items()
+             if latest is not None and latest is not NO_DATA]
+    if 'station_id' in request.match_info and not found:
+        raise web.HTTPNotFound()
+
+    offsets, units = await get_conversion(request)
+    values = datums.convert_levels(
+        [s for s, _ in found], [latest[1] for _, latest in found],
+        offsets, units)
+    data = [
+        {'station_id': s, 't': latest[0].strftime(TIME_FORMAT), 'v': v}
+        for (s, latest), v in zip(found, _levels_json(values))
+    ]
+    return web.json_response({'data': data})
+
+
+async def handle_predictions(request):
+    cache = request.app['cache']
+    station_id = int(request.match_info['station_id'])
+    try:
+        begin = np.datetime64(request.query['begin_date'], 's')
+        end = np.datetime64(request.query['end_date'], 's')
+    except (KeyError, ValueError):
+        raise web.HTTPBadRequest(
+            text="begin_date and end_date are required (YYYY-MM-DDTHH:MM)")
+
+    key = ('predictions', station_id)
+    series = cache.get(key)
+    if series is None:
+        series = await run_db(request.app, query_predictions, station_id)
+        cache.put(key, series, ttl=PREDICTIONS_TTL)
+
+    date_times, values = series
+    lo = np.searchsorted(date_times, begin, side='left')
+    hi = np.searchsorted(date_times, end, side='right')
+    offsets, units = await get_conversion(request)
+    values = datums.convert_levels(
+        np.full(hi - lo, station_id), values[lo:hi], offsets, units)
+    data = [
+        {'t': t.strftime(TIME_FORMAT), 'v': v}
+        for t, v in zip(date_times[lo:hi].tolist(), _levels_json(values))
+    ]
+    return web.json_response({'station_id': station_id, 'predictions': data})
+
+
+async def get_stations(app):
+    stations = app['cache'].get('stations')
+    if stations is None:
+        stations = await run_db(app, query_stations)
+        app['cache'].put('stations', stations, ttl=STATIONS_TTL)
+    return stations
+
+
+async def handle_stations(request):
+    stations = await get_stations(request.app)
+    inside = np.ones(len(stations['id']), dtype=bool)
+    if 'bbox' in request.query:
+        try:
+            min_lon, min_lat, max_lon, max_lat = (
+                float(x) for x in request.query['bbox'].split(','))
+        except ValueError:
+            raise web.HTTPBadRequest(
+                text="bbox is min_lon,min_lat,max_lon,max_lat")
+        inside = ((stations['longitude'] >= min_lon)
+                  & (stations['longitude'] <= max_lon)
+                  & (stations['latitude'] >= min_lat)
+                  & (stations['latitude'] <= max_lat))
+
+    data = [
+        {'id': stations['id'][i].item(), 'name': stations['name'][i],
+         'lat': stations['latitude'][i].item(),
+         'lon': stations['longitude'][i].item()}
+        for i in np.flatnonzero(inside)
+    ]
+    return web.json_response({'stations': data})
+
+
+async def invalidate_predictions(app):
+    """Drop the cached predictions of stations rewritten since the last check."""
+    station_ids, newest = await run_db(
+        app, query_updated_predictions, app.get('predictions_seen'))
+    for station_id in station_ids:
+        app['cache'].invalidate(('predictions', station_id))
+    app['predictions_seen'] = newest
+
+
+async def refresh_station_datums(app):
+    """Fetch missing and stale station datum tables, see datums.refresh_datums."""
+    stations = await get_stations(app)
+    refreshed = await run_db(app, datums.refresh_datums, stations['id'].tolist())
+    if refreshed:
+        app['cache'].invalidate_kind('datum_offsets')
+    app['datums_checked'] = time.monotonic()
+
+
+async def ingest_loop(app):
+    """
+    Run the water level ingest in-process and refresh the cache in place,
+    then evict the predictions tide_predictions.py rewrote meanwhile.
+    Station datum tables are checked once every DATUMS_TTL.
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        if time.monotonic() - app.get('datums_checked', -DATUMS_TTL) >= DATUMS_TTL:
+            try:
+                await refresh_station_datums(app)
+            except Exception as error:
+                print('datums refresh failed: {}'.format(error))
+        try:
+            new_rows = await loop.run_in_executor(
+                None, windy_bbox.get_water_levels_from_noaa)
+            unknown = app['cache'].update_latest(new_rows)
+            if unknown:
+                # Trust the database, not the batch, for uncached stations
+                for station_id, date_time, value in await run_db(
+                        app, query_latest, unknown):
+                    app['cache'].put(('latest', station_id), (date_time, value))
+        except Exception as error:
+            print('ingest failed: {}'.format(error))
+        try:
+            await invalidate_predictions(app)
+        except Exception as error:
+            print('predictions check failed: {}'.format(error))
+        await asyncio.sleep(INGEST_PERIOD)
+
+
+async def start_ingest(app):
+    app['ingest'] = asyncio.ensure_future(ingest_loop(app))
+
+
+async def stop_ingest(app):
+    app['ingest'].cancel()
+
+
+def make_app(with_ingest=True):
+    the_engine = datums.open_db()
+    hilo_predictions.DeclarativeBase.metadata.create_all(the_engine)
+    app = web.Application()
+    app['Session'] = sessionmaker(bind=the_engine)
+    app['cache'] = HotCache()
+    app.router.add_get('/latest', handle_latest)
+    app.router.add_get('/latest/{station_id:\\d+}', handle_latest)
+    app.router.add_get('/predictions/{station_id:\\d+}', handle_predictions)
+    app.router.add_get('/stations', handle_stations)
+    if with_ingest:
+        app.on_startup.append(start_ingest)
+        app.on_cleanup.append(stop_ingest)
+    return app
+
+
+if __name__ == "__main__":
+
+    web.run_app(make_app(), host='127.0.0.1', port=8080)
@@ -0,0 +1,230 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, Float, SmallInteger, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+import windy_bbox
+from windy_bbox import WaterLevelsDb
+from tide_predictions import PredictionsDb
+from ticks import TICK_SECONDS, to_ticks, from_ticks
+
+
+ROLLING_TICKS = 10  # one hour of 6-minute samples
+INITIAL_DEPTH = timedelta(days=1)
+MAX_LOOKBACK = timedelta(days=3)  # older gaps of lagging stations are dropped
+
+SURGE_THRESHOLD = 0.3  # meters between observed and predicted level
+RATE_THRESHOLD = 0.1  # meters of residual change per 6 minutes
+
+FLAG_POSITIVE_SURGE = 1
+FLAG_NEGATIVE_SURGE = 2
+FLAG_RATE_OF_CHANGE = 4
+
+
+def open_db():
+    my_engine = windy_bbox.open_db()
+    DeclarativeBase.metadata.create_all(my_engine)
+    return my_engine
+
+
+DeclarativeBase = declarative_base()
+
+
+class ResidualsDb(DeclarativeBase):
+    __tablename__ = 'residuals'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    date_time = Column('date_time', DateTime, primary_key=True)
+    residual = Column('residual', Float)
+    rolling_mean = Column('rolling_mean', Float)
+    rolling_std = Column('rolling_std', Float)
+    flags = Column('flags', SmallInteger, default=0)
+
+    def __repr__(self):
+        return "<Residual {} {} {}>".format(
+            self.station_id, self.date_time, self.residual)
+
+
+def load_series(session_db, model, value_column, begin, end):
+    """
+    Load (station_id, tick, value) arrays for all stations of a
+    water level table between the begin and end datetimes.
+    """
+    rows = session_db.query(
+        model.station_id, model.date_time, getattr(model, value_column)
+    ).filter(
+        model.date_time >= begin, model.date_time <= end
+    ).all()
+
+    if not rows:
+        return (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.float64))
+
+    station_ids, date_times, values = zip(*rows)
+    values = np.array(
+        [np.nan if v is None else float(v) for v in values], dtype=np.float64)
+    return (np.array(station_ids, dtype=np.int64), to_ticks(date_times),
+            values)
+
+
+def align_to_grid(station_ids, ticks, values, grid_stations, first_tick,
+                  n_ticks):
+    """
+    Scatter a long-format series onto a (station, tick) matrix.
+    Cells without a sample are NaN, duplicated samples keep the last value.
+    """
+    grid = np.full((len(grid_stations), n_ticks), np.nan)
+    rows = np.searchsorted(grid_stations, station_ids)
+    cols = ticks - first_tick
+    inside = (rows < len(grid_stations)) & (cols >= 0) & (cols < n_ticks)
+    inside[inside] &= grid_stations[rows[inside]] == station_ids[inside]
+    grid[rows[inside], cols[inside]] = values[inside]
+    return grid
+
+
+def rolling_mean_std(grid, window):
+    """NaN-aware trailing rolling mean and standard deviation along ticks."""
+    valid = ~np.isnan(grid)
+    filled = np.where(valid, grid, 0.0)
+    pad = np.zeros((grid.shape[0], 1))
+    csum = np.concatenate([pad, np.cumsum(filled, axis=1)], axis=1)
+    csq = np.concatenate([pad, np.cumsum(filled * filled, axis=1)], axis=1)
+    ccount = np.concatenate([pad, np.cumsum(valid, axis=1)], axis=1)
+
+    end = np.arange(1, grid.shape[1] + 1)
+    start = np.maximum(end - window, 0)
+    count = ccount[:, end] - ccount[:, start]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = (csum[:, end] - csum[:, start]) / count
+        var = (csq[:, end] - csq[:, start]) / count - mean * mean
+    std = np.sqrt(np.clip(var, 0.0, None))
+    mean[count == 0] = np.nan
+    std[count == 0] = np.nan
+    return mean, std
+
+
+def compute_residuals(observed, predicted, window=ROLLING_TICKS):
+    """
+    Compute residuals, their rolling statistics and exceedance flags
+    for aligned (station, tick) matrices of observations and predictions.
+    """
+    residual = observed - predicted
+    mean, std = rolling_mean_std(residual, window)
+
+    rate = np.full(residual.shape, np.nan)
+    rate[:, 1:] = residual[:, 1:] - residual[:, :-1]
+
+    flags = np.zeros(residual.shape, dtype=np.int16)
+    with np.errstate(invalid='ignore'):
+        flags[residual >= SURGE_THRESHOLD] |= FLAG_POSITIVE_SURGE
+        flags[residual <= -SURGE_THRESHOLD] |= FLAG_NEGATIVE_SURGE
+        flags[np.abs(rate) >= RATE_THRESHOLD] |= FLAG_RATE_OF_CHANGE
+
+    return residual, mean, std, flags
+
+
+def get_watermarks(session_db):
+    """Latest residual datetime already stored for every station."""
+    rows = session_db.query(
+        ResidualsDb.station_id, func.max(ResidualsDb.date_time)
+    ).group_by(ResidualsDb.station_id).all()
+    return dict(rows)
+
+
+def update_residuals(session_db, now=None, window=ROLLING_TICKS):
+    """
+    Compute residuals for the 6-minute batches that arrived since the
+    previous run and append them to the residuals table.
+
+    Only ticks newer than each station's stored watermark are written,
+    the extra rolling window of history is reloaded so that rolling
+    statistics of new ticks are complete. A station stops at its first
+    observation with no prediction yet, so that tick is computed once the
+    prediction arrives; ticks older than every stored prediction are
+    skipped, and nothing older than MAX_LOOKBACK is reloaded, which also
+    releases ticks whose prediction never arrives.
+    """
+    if now is None:
+        now = datetime.utcnow().replace(microsecond=0)
+
+    watermarks = get_watermarks(session_db)
+    if watermarks:
+        # A station that stopped reporting must not drag every run back
+        begin = max(min(watermarks.values()), now - MAX_LOOKBACK)
+    else:
+        begin = now - INITIAL_DEPTH
+    begin -= timedelta(seconds=TICK_SECONDS * window)
+
+    obs_ids, obs_ticks, obs_values = load_series(
+        session_db, WaterLevelsDb, 'water_level', begin, now)
+    if obs_ids.size == 0:
+        return []
+    pred_ids, pred_ticks, pred_values = load_series(
+        session_db, PredictionsDb, 'predicted_wl', begin, now)
+
+    grid_stations = np.unique(obs_ids)
+    first_tick = obs_ticks.min()
+    n_ticks = int(obs_ticks.max() - first_tick + 1)
+
+    observed = align_to_grid(
+        obs_ids, obs_ticks, obs_values, grid_stations, first_tick, n_ticks)
+    predicted = align_to_grid(
+        pred_ids, pred_ticks, pred_values, grid_stations, first_tick, n_ticks)
+    residual, mean, std, flags = compute_residuals(observed, predicted, window)
+
+    # Per-station watermark expressed as a tick, -1 for unseen stations
+    station_marks = np.array([
+        to_ticks([watermarks[s]])[0] if s in watermarks else -1
+        for s in grid_stations.tolist()
+    ], dtype=np.int64)
+    grid_ticks = first_tick + np.arange(n_ticks)
+    is_new = grid_ticks[np.newaxis, :] > station_marks[:, np.newaxis]
+    # Hold each station back at its first observation still missing a
+    # prediction, the watermark must not move past it. tide_predictions.py
+    # purges predictions before midnight, so older ticks never get one
+    pending = is_new & ~np.isnan(observed) & np.isnan(predicted)
+    if pred_ticks.size:
+        pending &= grid_ticks[np.newaxis, :] >= pred_ticks.min()
+    first_pending = np.where(pending.any(axis=1), pending.argmax(axis=1), n_ticks)
+    is_ready = np.arange(n_ticks)[np.newaxis, :] < first_pending[:, np.newaxis]
+    rows, cols = np.nonzero(is_new & is_ready & ~np.isnan(residual))
+
+    date_times = from_ticks(grid_ticks[cols]).tolist()
+    new_residuals = [
+        {
+            'station_id': station_id,
+            'date_time': date_time,
+            'residual': value,
+            'rolling_mean': None if np.isnan(m) else m,
+            'rolling_std': None if np.isnan(s) else s,
+            'flags': flag,
+        }
+        for station_id, date_time, value, m, s, flag in zip(
+            grid_stations[rows].tolist(),
+            date_times,
+            residual[rows, cols].tolist(),
+            mean[rows, cols].tolist(),
+            std[rows, cols].tolist(),
+            flags[rows, cols].tolist(),
+        )
+    ]
+
+    session_db.bulk_insert_mappings(ResidualsDb, new_residuals)
+    session_db.commit()
+
+    return new_residuals
+
+
+if __name__ == "__main__":
+
+    the_engine = open_db()
+    Session = sessionmaker(bind=the_engine)
+    session = Session()
+
+    surges = [r for r in update_residuals(session) if r['flags']]
+    print('{} flagged residuals'.format(len(surges)))
+    for surge in surges[-10:]:
+        print(surge)
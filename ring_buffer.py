@@ -0,0 +1,219 @@
+import fcntl
+import os
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import windy_bbox
+from ticks import TICK_SECONDS, to_ticks, from_ticks
+
+RING_PATH = 'water_levels.ring'
+RING_SLOTS = 72 * 10  # 72 hours of 6-minute ticks
+
+MAGIC = b'WLRING01'
+HEADER_BYTES = 64
+EMPTY_TICK = -1
+
+
+class RingBuffer:
+    """
+    Fixed-size memory-mapped file of the recent 6-minute water levels of
+    every station: one slot array per station indexed by tick % slots.
+
+    File layout: a 64-byte header (magic, stations, slots), the sorted
+    int64 station ids, int64 ticks[stations, slots] and float32
+    values[stations, slots]. A slot is valid only when its stored tick
+    is the requested one, so readers never see wrapped-over samples.
+    Any number of processes may map the file read-only; writers go
+    through put_rows, which holds the ring lock while writing.
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        with open(path, 'rb') as ring_file:
+            if ring_file.read(len(MAGIC)) != MAGIC:
+                raise ValueError('{} is not a water level ring'.format(path))
+        header = np.memmap(path, dtype=np.int64, mode='r', shape=(3,),
+                           offset=len(MAGIC))
+        n_stations, n_slots, tick_seconds = (int(x) for x in header)
+        if tick_seconds != TICK_SECONDS:
+            raise ValueError('{} has {}-second ticks'.format(path, tick_seconds))
+
+        offset = HEADER_BYTES
+        self.station_ids = np.memmap(path, dtype=np.int64, mode=mode,
+                                     shape=(n_stations,), offset=offset)
+        offset += 8 * n_stations
+        self.ticks = np.memmap(path, dtype=np.int64, mode=mode,
+                               shape=(n_stations, n_slots), offset=offset)
+        offset += 8 * n_stations * n_slots
+        self.values = np.memmap(path, dtype=np.float32, mode=mode,
+                                shape=(n_stations, n_slots), offset=offset)
+        self.n_slots = n_slots
+
+    @classmethod
+    def create(cls, path, station_ids, n_slots=RING_SLOTS):
+        station_ids = np.unique(np.asarray(station_ids, dtype=np.int64))
+        n_stations = len(station_ids)
+        size = HEADER_BYTES + 8 * n_stations + 12 * n_stations * n_slots
+        with open(path, 'wb') as ring_file:
+            ring_file.write(MAGIC)
+            ring_file.write(np.array(
+                [n_stations, n_slots, TICK_SECONDS], dtype=np.int64).tobytes())
+            ring_file.truncate(size)
+
+        ring = cls(path, mode='r+')
+        ring.station_ids[:] = station_ids
+        ring.ticks[:] = EMPTY_TICK
+        ring.values[:] = np.nan
+        ring.flush()
+        return ring
+
+    def flush(self):
+        for array in (self.station_ids, self.ticks, self.values):
+            array.flush()
+
+    def rows_of(self, station_ids):
+        """Row of each station id in the ring, -1 for unknown stations."""
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        if len(self.station_ids) == 0:
+            return np.full(station_ids.shape, -1)
+        rows = np.minimum(np.searchsorted(self.station_ids, station_ids),
+                          len(self.station_ids) - 1)
+        return np.where(self.station_ids[rows] == station_ids, rows, -1)
+
+    def write(self, station_ids, date_times, values):
+        """Store samples in place, older samples never overwrite newer."""
+        rows = self.rows_of(station_ids)
+        ticks = to_ticks(date_times)
+        values = np.asarray(values, dtype=np.float32)
+        slots = ticks % self.n_slots
+        keep = (rows >= 0) & (ticks >= self.ticks[np.maximum(rows, 0), slots])
+        rows, slots, ticks, values = rows[keep], slots[keep], ticks[keep], values[keep]
+        # Invalidate the slots before touching their values: a reader
+        # checking the tick sees either the old sample, an empty slot
+        # or the new sample, never a wrapped slot with the new value
+        self.ticks[rows, slots] = EMPTY_TICK
+        self.values[rows, slots] = values
+        self.ticks[rows, slots] = ticks
+        self.flush()
+        return int(keep.sum())
+
+    def latest_tick(self, now=None):
+        """
+        Newest stored tick not after now, so one station stamped in the
+        future does not move the window and snapshot defaults past the
+        samples of all the others.
+        """
+        now_tick = to_ticks(datetime.utcnow() if now is None else now)
+        ticks = self.ticks[self.ticks <= now_tick]
+        return int(ticks.max()) if ticks.size else EMPTY_TICK
+
+    def window(self, station_id, n_ticks=RING_SLOTS, end_tick=None):
+        """
+        Datetimes and values of a station over the last n_ticks ticks
+        ending at end_tick, NaN where no sample is stored.
+        """
+        row = int(self.rows_of([station_id])[0])
+        if end_tick is None:
+            end_tick = self.latest_tick()
+        ticks = np.arange(end_tick - min(n_ticks, self.n_slots) + 1, end_tick + 1)
+        if row < 0:
+            return from_ticks(ticks), np.full(len(ticks), np.nan, np.float32)
+        slots = ticks % self.n_slots
+        values = np.where(self.ticks[row, slots] == ticks,
+                          self.values[row, slots], np.nan)
+        return from_ticks(ticks), values
+
+    def snapshot(self, tick=None):
+        """Station ids and the values of all stations at one tick."""
+        if tick is None:
+            tick = self.latest_tick()
+        slot = tick % self.n_slots
+        values = np.where(self.ticks[:, slot] == tick,
+                          self.values[:, slot], np.nan)
+        return np.asarray(self.station_ids), values
+
+
+@contextmanager
+def ring_lock(path=RING_PATH):
+    """
+    Exclusive lock of the ring writers. Sharded workers, windy_bbox and
+    the read service all write the same file, and a rebuild replaces it.
+    """
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def open_ring(station_ids, path=RING_PATH):
+    """
+    Open the ring for writing, creating it when missing and rebuilding it
+    when the station list changed; samples of kept stations are carried.
+    Returns the ring and the ids of the stations that have no samples
+    yet. Call it under ring_lock.
+    """
+    station_ids = np.unique(np.asarray(station_ids, dtype=np.int64))
+    if os.path.exists(path):
+        ring = RingBuffer(path, mode='r+')
+        if np.array_equal(ring.station_ids, station_ids):
+            return ring, np.empty(0, dtype=np.int64)
+        rebuilt = RingBuffer.create(path + '.new', station_ids, ring.n_slots)
+        rows = rebuilt.rows_of(ring.station_ids)
+        kept = rows >= 0
+        rebuilt.ticks[rows[kept]] = ring.ticks[kept]
+        rebuilt.values[rows[kept]] = ring.values[kept]
+        rebuilt.flush()
+        added = np.setdiff1d(station_ids, ring.station_ids)
+        del ring, rebuilt
+        # Readers holding the old mapping keep reading the old file
+        os.replace(path + '.new', path)
+        return RingBuffer(path, mode='r+'), added
+    return RingBuffer.create(path, station_ids), station_ids
+
+
+def seed_from_db(session_db, ring, station_ids):
+    """Fill stations new to the ring with their stored recent levels."""
+    since = datetime.utcnow() - timedelta(seconds=TICK_SECONDS * ring.n_slots)
+    rows = session_db.query(
+        windy_bbox.WaterLevelsDb.station_id, windy_bbox.WaterLevelsDb.date_time,
+        windy_bbox.WaterLevelsDb.water_level,
+    ).filter(
+        windy_bbox.WaterLevelsDb.station_id.in_(station_ids.tolist()),
+        windy_bbox.WaterLevelsDb.date_time >= since,
+    ).all()
+    return _write_rows(ring, rows)
+
+
+def _write_rows(ring, rows):
+    if not rows:
+        return 0
+    row_station_ids, date_times, values = zip(*rows)
+    return ring.write(
+        row_station_ids, np.array(date_times, dtype='datetime64[s]'),
+        [np.nan if v is None else float(v) for v in values])
+
+
+def put_rows(session_db, new_rows, path=RING_PATH):
+    """
+    Write ingested (station_id, date_time, value) rows to the ring of
+    all stations, seeding a new or rebuilt ring from the database first.
+    """
+    station_ids = [s for s, in session_db.query(windy_bbox.StationDb.id)]
+    with ring_lock(path):
+        ring, unseeded = open_ring(station_ids, path)
+        if unseeded.size:
+            seed_from_db(session_db, ring, unseeded)
+        return _write_rows(ring, new_rows)
+
+
+if __name__ == "__main__":
+
+    ring = RingBuffer(RING_PATH)
+    station_ids, levels = ring.snapshot()
+    print('{}: {} of {} stations reported'.format(
+        from_ticks(ring.latest_tick()), int((~np.isnan(levels)).sum()),
+        len(station_ids)))
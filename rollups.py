@@ -0,0 +1,305 @@
+import numpy as np
+import pandas as pd
+from sqlalchemy import Column, Integer, Float, String, Date, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+
+HOUR_SECONDS = 3600
+DAY_SECONDS = 86400
+
+
+DeclarativeBase = declarative_base()
+
+
+class HourlyRollupDb(DeclarativeBase):
+    __tablename__ = 'hourly_rollups'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    product = Column('product', String(16), primary_key=True)
+    hour = Column('hour', DateTime, primary_key=True)
+    mean = Column('mean', Float)
+    min = Column('min', Float)
+    max = Column('max', Float)
+    count = Column('count', Integer)
+
+    def __repr__(self):
+        return "<HourlyRollup {} {} {}>".format(
+            self.station_id, self.product, self.hour)
+
+
+class DailyRollupDb(DeclarativeBase):
+    __tablename__ = 'daily_rollups'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    product = Column('product', String(16), primary_key=True)
+    day = Column('day', Date, primary_key=True)
+    high = Column('high', Float)
+    high_time = Column('high_time', DateTime)
+    low = Column('low', Float)
+    low_time = Column('low_time', DateTime)
+
+    def __repr__(self):
+        return "<DailyRollup {} {} {}>".format(
+            self.station_id, self.product, self.day)
+
+
+def aggregate_buckets(station_ids, seconds, values, bucket_seconds):
+    """
+    Group samples by (station, time bucket) and return per-bucket
+    station ids, bucket starts (epoch seconds), count, mean, min, max
+    and the epoch seconds at which the min and max occurred.
+    """
+    keep = ~np.isnan(values)
+    station_ids = station_ids[keep]
+    seconds = seconds[keep]
+    values = values[keep]
+    buckets = seconds // bucket_seconds
+
+    order = np.lexsort((seconds, buckets, station_ids))
+    station_ids = station_ids[order]
+    seconds = seconds[order]
+    values = values[order]
+    buckets = buckets[order]
+
+    n = len(values)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return {'station_id': empty, 'bucket': empty, 'count': empty,
+                'mean': np.empty(0), 'min': np.empty(0), 'max': np.empty(0),
+                'min_time': empty, 'max_time': empty}
+
+    new_group = np.ones(n, dtype=bool)
+    new_group[1:] = ((station_ids[1:] != station_ids[:-1])
+                     | (buckets[1:] != buckets[:-1]))
+    starts = np.flatnonzero(new_group)
+    group_of = np.cumsum(new_group) - 1
+    count = np.diff(np.append(starts, n))
+
+    # Within each group the first sample after sorting by value is the extreme
+    by_high = np.lexsort((-values, group_of))
+    by_low = np.lexsort((values, group_of))
+
+    return {
+        'station_id': station_ids[starts],
+        'bucket': buckets[starts] * bucket_seconds,
+        'count': count,
+        'mean': np.add.reduceat(values, starts) / count,
+        'min': values[by_low[starts]],
+        'max': values[by_high[starts]],
+        'min_time': seconds[by_low[starts]],
+        'max_time': seconds[by_high[starts]],
+    }
+
+
+def _to_datetimes(seconds):
+    return np.asarray(seconds, dtype=np.int64).astype('datetime64[s]').tolist()
+
+
+def _touched_buckets(new_rows, bucket_seconds):
+    touched = {}
+    for row in new_rows:
+        station_id, date_time = row[0], row[1]
+        seconds = int(np.datetime64(date_time, 's').astype(np.int64))
+        bucket = seconds // bucket_seconds * bucket_seconds
+        touched.setdefault(int(station_id), set()).add(bucket)
+    return touched
+
+
+def _rescan_buckets(session_db, model, value_column, product, hours, days):
+    """Re-aggregate the given {station_id: buckets} from the raw table."""
+    begin = min(min(b) for b in days.values())
+    end = max(max(b) for b in days.values()) + DAY_SECONDS
+    value = getattr(model, value_column)
+    rows = session_db.query(model.station_id, model.date_time, value).filter(
+        model.station_id.in_(list(days)),
+        model.date_time >= _to_datetimes([begin])[0],
+        model.date_time < _to_datetimes([end])[0],
+    ).all()
+
+    if rows:
+        station_ids, date_times, values = zip(*rows)
+        station_ids = np.array(station_ids, dtype=np.int64)
+        seconds = np.array(date_times, dtype='datetime64[s]').astype(np.int64)
+        values = np.array(
+            [np.nan if v is None else float(v) for v in values])
+    else:
+        station_ids = seconds = np.empty(0, dtype=np.int64)
+        values = np.empty(0)
+
+    hourly = aggregate_buckets(station_ids, seconds, values, HOUR_SECONDS)
+    daily = aggregate_buckets(station_ids, seconds, values, DAY_SECONDS)
+
+    for station_id, buckets in hours.items():
+        session_db.query(HourlyRollupDb).filter(
+            HourlyRollupDb.station_id == station_id,
+            HourlyRollupDb.product == product,
+            HourlyRollupDb.hour.in_(_to_datetimes(sorted(buckets))),
+        ).delete(synchronize_session=False)
+    for station_id, buckets in days.items():
+        session_db.query(DailyRollupDb).filter(
+            DailyRollupDb.station_id == station_id,
+            DailyRollupDb.product == product,
+            DailyRollupDb.day.in_(
+                [d.date() for d in _to_datetimes(sorted(buckets))]),
+        ).delete(synchronize_session=False)
+
+    session_db.bulk_insert_mappings(HourlyRollupDb, [
+        {
+            'station_id': station_id,
+            'product': product,
+            'hour': hour,
+            'mean': mean,
+            'min': low,
+            'max': high,
+            'count': count,
+        }
+        for station_id, hour, seconds_, mean, low, high, count in zip(
+            hourly['station_id'].tolist(),
+            _to_datetimes(hourly['bucket']),
+            hourly['bucket'].tolist(),
+            hourly['mean'].tolist(),
+            hourly['min'].tolist(),
+            hourly['max'].tolist(),
+            hourly['count'].tolist(),
+        )
+        if seconds_ in hours.get(station_id, ())
+    ])
+    session_db.bulk_insert_mappings(DailyRollupDb, [
+        {
+            'station_id': station_id,
+            'product': product,
+            'day': day.date(),
+            'high': high,
+            'high_time': high_time,
+            'low': low,
+            'low_time': low_time,
+        }
+        for station_id, day, seconds_, high, high_time, low, low_time in zip(
+            daily['station_id'].tolist(),
+            _to_datetimes(daily['bucket']),
+            daily['bucket'].tolist(),
+            daily['max'].tolist(),
+            _to_datetimes(daily['max_time']),
+            daily['min'].tolist(),
+            _to_datetimes(daily['min_time']),
+        )
+        if seconds_ in days.get(station_id, ())
+    ])
+
+
+def _merge_rows(session_db, product, rows, skip_hours, skip_days):
+    """
+    Merge newly inserted rows into the stored rollups of their buckets,
+    the buckets in skip_hours and skip_days were already rescanned.
+    """
+    station_ids = np.array([int(r[0]) for r in rows], dtype=np.int64)
+    seconds = np.array([r[1] for r in rows], dtype='datetime64[s]').astype(np.int64)
+    values = np.array([np.nan if r[2] is None else float(r[2]) for r in rows])
+    hourly = aggregate_buckets(station_ids, seconds, values, HOUR_SECONDS)
+    daily = aggregate_buckets(station_ids, seconds, values, DAY_SECONDS)
+    ids = sorted(set(station_ids.tolist()))
+
+    if len(hourly['bucket']):
+        hour_times = _to_datetimes(hourly['bucket'])
+        stored = {(r.station_id, r.hour): r for r in session_db.query(HourlyRollupDb).filter(
+            HourlyRollupDb.station_id.in_(ids),
+            HourlyRollupDb.product == product,
+            HourlyRollupDb.hour >= min(hour_times),
+            HourlyRollupDb.hour <= max(hour_times),
+        )}
+        for station_id, hour, seconds_, count, mean, low, high in zip(
+                hourly['station_id'].tolist(), hour_times, hourly['bucket'].tolist(),
+                hourly['count'].tolist(), hourly['mean'].tolist(),
+                hourly['min'].tolist(), hourly['max'].tolist()):
+            if seconds_ in skip_hours.get(station_id, ()):
+                continue
+            rollup = stored.get((station_id, hour))
+            if rollup is None:
+                session_db.add(HourlyRollupDb(
+                    station_id=station_id, product=product, hour=hour,
+                    mean=mean, min=low, max=high, count=count))
+                continue
+            total = rollup.count + count
+            rollup.mean = (rollup.mean * rollup.count + mean * count) / total
+            rollup.count = total
+            rollup.min = min(rollup.min, low)
+            rollup.max = max(rollup.max, high)
+
+    if len(daily['bucket']):
+        days = [d.date() for d in _to_datetimes(daily['bucket'])]
+        stored = {(r.station_id, r.day): r for r in session_db.query(DailyRollupDb).filter(
+            DailyRollupDb.station_id.in_(ids),
+            DailyRollupDb.product == product,
+            DailyRollupDb.day >= min(days),
+            DailyRollupDb.day <= max(days),
+        )}
+        for station_id, day, seconds_, high, high_time, low, low_time in zip(
+                daily['station_id'].tolist(), days, daily['bucket'].tolist(),
+                daily['max'].tolist(), _to_datetimes(daily['max_time']),
+                daily['min'].tolist(), _to_datetimes(daily['min_time'])):
+            if seconds_ in skip_days.get(station_id, ()):
+                continue
+            rollup = stored.get((station_id, day))
+            if rollup is None:
+                session_db.add(DailyRollupDb(
+                    station_id=station_id, product=product, day=day,
+                    high=high, high_time=high_time, low=low, low_time=low_time))
+                continue
+            if high > rollup.high:
+                rollup.high, rollup.high_time = high, high_time
+            if low < rollup.low:
+                rollup.low, rollup.low_time = low, low_time
+
+
+def update_rollups(session_db, model, value_column, product, new_rows, revised=()):
+    """
+    Update hourly and daily rollups with the newly written
+    (station_id, date_time, value, ...) rows of a water level table.
+
+    Rows of new ticks are merged into the stored mean, count, min and max
+    of their buckets. A bucket holding a revised value, such as a verified
+    level replacing the preliminary one, is re-aggregated from the raw
+    table, since a replaced extreme cannot be taken back incrementally.
+    revised holds the (station_id, date_time) keys of the revised rows.
+    """
+    revised = set(revised)
+    rescan_rows = [row for row in new_rows if (row[0], row[1]) in revised]
+    hours = _touched_buckets(rescan_rows, HOUR_SECONDS)
+    days = _touched_buckets(rescan_rows, DAY_SECONDS)
+    if days:
+        _rescan_buckets(session_db, model, value_column, product, hours, days)
+
+    merge_rows = [row for row in new_rows if (row[0], row[1]) not in revised]
+    if merge_rows:
+        _merge_rows(session_db, product, merge_rows, hours, days)
+    session_db.commit()
+
+
+def get_hourly(session_db, station_id, product, begin, end):
+    """Hourly mean/min/max of a station as a dataframe indexed by hour."""
+    query = session_db.query(HourlyRollupDb).filter(
+        HourlyRollupDb.station_id == station_id,
+        HourlyRollupDb.product == product,
+        HourlyRollupDb.hour >= begin,
+        HourlyRollupDb.hour <= end,
+    ).order_by(HourlyRollupDb.hour)
+    df = pd.DataFrame(
+        [(r.hour, r.mean, r.min, r.max, r.count) for r in query],
+        columns=['date_time', 'mean', 'min', 'max', 'count'],
+    )
+    return df.set_index('date_time')
+
+
+def get_daily(session_db, station_id, product, begin, end):
+    """Daily high/low of a station with their times, indexed by date."""
+    query = session_db.query(DailyRollupDb).filter(
+        DailyRollupDb.station_id == station_id,
+        DailyRollupDb.product == product,
+        DailyRollupDb.day >= begin,
+        DailyRollupDb.day <= end,
+    ).order_by(DailyRollupDb.day)
+    df = pd.DataFrame(
+        [(r.day, r.high, r.high_time, r.low, r.low_time) for r in query],
+        columns=['date_time', 'high', 'high_time', 'low', 'low_time'],
+    )
+    return df.set_index('date_time')
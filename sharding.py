@@ -0,0 +1,289 @@
+import argparse
+import bisect
+import hashlib
+import multiprocessing
+import socket
+import threading
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy import Column, Integer, String, DateTime
+from sqlalchemy.ext.declarative import declarative_base
+
+import fingerprints
+import noaa_stations
+import ring_buffer
+import rollups
+import windy_bbox
+from windy_bbox import StationDb, WaterLevelsDb
+
+
+VIRTUAL_NODES = 64  # ring points per worker, evens out the station split
+LEASE_TTL = timedelta(minutes=3)
+HEARTBEAT_SECONDS = 60
+CYCLE_SECONDS = 6 * 60
+INGEST_DEPTH = timedelta(hours=1)
+
+
+DeclarativeBase = declarative_base()
+
+
+class WorkerLeaseDb(DeclarativeBase):
+    __tablename__ = 'worker_leases'
+
+    worker_id = Column('worker_id', String(64), primary_key=True)
+    host = Column('host', String(64))
+    heartbeat_at = Column('heartbeat_at', DateTime)
+    expires_at = Column('expires_at', DateTime, index=True)
+
+    def __repr__(self):
+        return "<WorkerLease {} {}>".format(self.worker_id, self.expires_at)
+
+
+class StationLeaseDb(DeclarativeBase):
+    __tablename__ = 'station_leases'
+
+    station_id = Column(Integer, primary_key=True, autoincrement=False)
+    worker_id = Column('worker_id', String(64), index=True)
+    expires_at = Column('expires_at', DateTime)
+
+    def __repr__(self):
+        return "<StationLease {} {}>".format(self.station_id, self.worker_id)
+
+
+def open_lease_db(lease_url=None):
+    """
+    Lease tables live in the main database, or in any SQLAlchemy URL
+    such as sqlite:///leases.sqlite for workers of a single host.
+    """
+    if lease_url is None:
+        my_engine = windy_bbox.open_db()
+    else:
+        my_engine = engine.create_engine(lease_url)
+    DeclarativeBase.metadata.create_all(my_engine)
+    return my_engine
+
+
+def _ring_position(key):
+    return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """
+    Consistent hash ring of worker ids. When a worker joins or leaves,
+    only the stations of the neighbouring ring segments change owner.
+    """
+
+    def __init__(self, worker_ids, virtual_nodes=VIRTUAL_NODES):
+        points = sorted(
+            (_ring_position('{}#{}'.format(worker_id, i)), worker_id)
+            for worker_id in worker_ids
+            for i in range(virtual_nodes)
+        )
+        self.positions = [position for position, _ in points]
+        self.workers = [worker_id for _, worker_id in points]
+
+    def owner(self, station_id):
+        if not self.workers:
+            return None
+        i = bisect.bisect(self.positions, _ring_position(station_id))
+        return self.workers[i % len(self.workers)]
+
+    def assign(self, station_ids, worker_id):
+        return [s for s in station_ids if self.owner(s) == worker_id]
+
+
+def heartbeat(session_db, worker_id):
+    """Extend the lease of the worker and of the stations it holds."""
+    now = datetime.utcnow().replace(microsecond=0)
+    session_db.merge(WorkerLeaseDb(
+        worker_id=worker_id,
+        host=socket.gethostname(),
+        heartbeat_at=now,
+        expires_at=now + LEASE_TTL,
+    ))
+    session_db.query(StationLeaseDb).filter(
+        StationLeaseDb.worker_id == worker_id,
+    ).update({'expires_at': now + LEASE_TTL}, synchronize_session=False)
+    session_db.commit()
+
+
+def live_workers(session_db):
+    now = datetime.utcnow()
+    return [worker_id for worker_id, in session_db.query(
+        WorkerLeaseDb.worker_id,
+    ).filter(WorkerLeaseDb.expires_at > now).all()]
+
+
+def claim_stations(session_db, worker_id, station_ids):
+    """
+    Renew or take over the leases of the stations this worker owns and
+    release the rest. A station still leased by another live worker is
+    left alone until that worker releases it or its lease expires, so
+    no station is fetched twice while the ring rebalances.
+    """
+    now = datetime.utcnow().replace(microsecond=0)
+    expires_at = now + LEASE_TTL
+
+    session_db.query(StationLeaseDb).filter(
+        StationLeaseDb.worker_id == worker_id,
+        StationLeaseDb.station_id.notin_(station_ids),
+    ).delete(synchronize_session=False)
+    if station_ids:
+        session_db.query(StationLeaseDb).filter(
+            StationLeaseDb.station_id.in_(station_ids),
+            (StationLeaseDb.worker_id == worker_id)
+            | (StationLeaseDb.expires_at < now),
+        ).update({'worker_id': worker_id, 'expires_at': expires_at},
+                 synchronize_session=False)
+    session_db.commit()
+
+    leased = dict(session_db.query(
+        StationLeaseDb.station_id, StationLeaseDb.worker_id,
+    ).filter(StationLeaseDb.station_id.in_(station_ids)).all())
+    for station_id in station_ids:
+        if station_id in leased:
+            continue
+        session_db.add(StationLeaseDb(
+            station_id=station_id, worker_id=worker_id, expires_at=expires_at))
+        try:
+            session_db.commit()
+            leased[station_id] = worker_id
+        except IntegrityError:
+            # Another worker inserted the lease first
+            session_db.rollback()
+
+    return [s for s in station_ids if leased.get(s) == worker_id]
+
+
+def leave(session_db, worker_id):
+    session_db.query(StationLeaseDb).filter(
+        StationLeaseDb.worker_id == worker_id,
+    ).delete(synchronize_session=False)
+    session_db.query(WorkerLeaseDb).filter(
+        WorkerLeaseDb.worker_id == worker_id,
+    ).delete(synchronize_session=False)
+    session_db.commit()
+
+
+def ingest_water_levels(session_db, stations_list):
+    """Fetch the last hour of water levels of the given stations."""
+    today = datetime.utcnow().replace(microsecond=0)
+    past = today - INGEST_DEPTH
+    tide_data = noaa_stations.get_data(
+        stations_list,
+        begin_date=past.strftime("%Y%m%d %H:%M"),
+        end_date=today.strftime("%Y%m%d %H:%M"),
+        product="water_level",
+        datum="MLLW",
+        )
+    if tide_data.empty:
+        return []
+    # NOAA gaps ("v": "") parse to NaN, MySQL cannot store them
+    tide_data = tide_data.dropna(subset=['water_level'])
+    if tide_data.empty:
+        return []
+
+    measures = dict(zip(
+        zip(tide_data['station_id'].astype(int).tolist(),
+            tide_data.index.to_pydatetime().tolist()),
+        tide_data['water_level'].astype(float).tolist(),
+        ))
+    revised = []
+    new_rows = fingerprints.write_changed_rows(
+        session_db, WaterLevelsDb, 'water_level', measures, revised)
+    session_db.commit()
+    rollups.update_rollups(
+        session_db, WaterLevelsDb, 'water_level', 'water_level', new_rows,
+        revised)
+    ring_buffer.put_rows(session_db, new_rows)
+    return new_rows
+
+
+def keep_alive(LeaseSession, worker_id, stop):
+    """
+    Heartbeat from a background thread until stop is set, so the worker
+    and station leases stay alive while a long ingest job is running.
+    """
+    lease_db = LeaseSession()
+    try:
+        while not stop.wait(HEARTBEAT_SECONDS):
+            try:
+                heartbeat(lease_db, worker_id)
+            except Exception as error:
+                lease_db.rollback()
+                print('{}: heartbeat failed: {}'.format(worker_id, error))
+    finally:
+        lease_db.close()
+
+
+def run_worker(worker_id, lease_url=None, job=ingest_water_levels, cycles=None):
+    """
+    Every cycle: heartbeat, rebuild the ring over the live workers, claim
+    this worker's share of the stations and run the ingest job on it.
+    A failed cycle is logged and the worker carries on with the next one.
+    """
+    Session = sessionmaker(bind=windy_bbox.open_db())
+    LeaseSession = sessionmaker(bind=open_lease_db(lease_url))
+    session_db = Session()
+    lease_db = LeaseSession()
+
+    heartbeat(lease_db, worker_id)
+    stop = threading.Event()
+    heartbeats = threading.Thread(
+        target=keep_alive, args=(LeaseSession, worker_id, stop), daemon=True)
+    heartbeats.start()
+
+    cycle = 0
+    try:
+        while True:
+            try:
+                heartbeat(lease_db, worker_id)
+                ring = HashRing(live_workers(lease_db))
+                station_ids = [s for s, in session_db.query(StationDb.id).all()]
+                owned = ring.assign(station_ids, worker_id)
+                claimed = claim_stations(lease_db, worker_id, owned)
+                print('{}: {} owned, {} claimed of {} stations'.format(
+                    worker_id, len(owned), len(claimed), len(station_ids)))
+                if claimed:
+                    job(session_db, claimed)
+            except Exception as error:
+                session_db.rollback()
+                lease_db.rollback()
+                print('{}: cycle failed: {}'.format(worker_id, error))
+
+            cycle += 1
+            if cycles is not None and cycle >= cycles:
+                break
+            # Leases are kept alive by the heartbeat thread meanwhile
+            next_cycle = (time.time() // CYCLE_SECONDS + 1) * CYCLE_SECONDS
+            time.sleep(max(next_cycle - time.time(), 0))
+    finally:
+        stop.set()
+        heartbeats.join()
+        leave(lease_db, worker_id)
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(
+        description="Run sharded ingest workers on this host")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--lease-url', default=None,
+                        help="e.g. sqlite:///leases.sqlite for local runs")
+    args = parser.parse_args()
+
+    processes = [
+        multiprocessing.Process(
+            target=run_worker,
+            args=('{}-{}'.format(socket.gethostname(), i), args.lease_url),
+        )
+        for i in range(args.workers)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
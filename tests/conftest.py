@@ -0,0 +1,23 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+
+@pytest.fixture
+def sqlite_session():
+    """Factory of in-memory SQLite sessions holding the given declarative bases."""
+    sessions = []
+
+    def make_session(*bases):
+        engine = create_engine('sqlite://', poolclass=StaticPool,
+                               connect_args={'check_same_thread': False})
+        for base in bases:
+            base.metadata.create_all(engine)
+        session = sessionmaker(bind=engine)()
+        sessions.append(session)
+        return session
+
+    yield make_session
+    for session in sessions:
+        session.close()
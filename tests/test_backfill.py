@@ -0,0 +1,110 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import backfill
+from backfill import HistoryLevelsDb
+
+
+PAYLOADS = {
+    '1': {'data': [{'t': '2022-01-01 00:00', 'v': '1.250', 'f': '0,0,0'}]},
+    '2': {'error': {'message': 'No data was found. This product may not be '
+                               'offered at this station at the requested time.'}},
+    '3': {'error': {'message': 'Wrong Datum: Datum cannot be null or empty'}},
+}
+
+
+def test_plan_and_resume_work_units():
+    work_db = backfill.open_work_db(':memory:')
+    backfill.plan_work_units(work_db, [1, 2], ['hourly_height'],
+                             datetime(2020, 1, 1), datetime(2021, 6, 1))
+    backfill.plan_work_units(work_db, [1, 2], ['hourly_height'],
+                             datetime(2020, 1, 1), datetime(2021, 6, 1))
+    units = backfill.resume_work_units(work_db)
+    assert len(units) == 4
+    assert units[0] == (1, 'hourly_height', '20200101 00:00', '20201230 23:59')
+
+    backfill.mark_work_unit(work_db, units[0], 'running')
+    backfill.mark_work_unit(work_db, units[1], 'done', rows=10)
+    assert len(backfill.resume_work_units(work_db)) == 3
+
+
+def test_only_no_data_errors_count_as_done(monkeypatch):
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    backfill.DeclarativeBase.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    work_db = backfill.open_work_db(':memory:')
+    backfill.plan_work_units(work_db, [1, 2, 3], ['hourly_height'],
+                             datetime(2022, 1, 1), datetime(2022, 1, 2))
+
+    async def handle(request):
+        return web.json_response(PAYLOADS[request.query['station']])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/', handle)
+        async with TestServer(app) as server:
+            url = str(server.make_url('/?product=hourly_height'))
+            monkeypatch.setattr(backfill.noaa_stations, 'build_base_url',
+                                lambda *args, **kwargs: url)
+            db_executor = ThreadPoolExecutor(max_workers=1)
+            async with aiohttp.ClientSession() as http:
+                for unit in backfill.resume_work_units(work_db):
+                    await backfill.run_work_unit(
+                        http, Session, db_executor, work_db, unit, 'MLLW')
+            db_executor.shutdown()
+
+    asyncio.run(run())
+
+    status = dict(work_db.execute(
+        "SELECT station_id, status FROM work_units").fetchall())
+    assert status == {1: 'done', 2: 'done', 3: 'failed'}
+    assert [u[0] for u in backfill.resume_work_units(work_db)] == [3]
+    assert Session().query(HistoryLevelsDb).count() == 1
+
+
+def test_failed_units_are_retried_in_the_same_run(monkeypatch):
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    backfill.DeclarativeBase.metadata.create_all(engine)
+    Session = sessionmaker(bind=engine)
+    work_db = backfill.open_work_db(':memory:')
+    backfill.plan_work_units(work_db, [1, 3, 4], ['hourly_height'],
+                             datetime(2022, 1, 1), datetime(2022, 1, 2))
+    monkeypatch.setattr(backfill, 'MAX_ATTEMPTS', 3)
+    monkeypatch.setattr(backfill, 'RETRY_DELAY', 0.01)
+    requests = []
+
+    async def handle(request):
+        station = request.query['station']
+        requests.append(station)
+        # Station 3 recovers on its third attempt, station 4 never does
+        if station == '4' or (station == '3' and requests.count(station) < 3):
+            return web.Response(status=503)
+        return web.json_response(PAYLOADS['1'])
+
+    async def run():
+        app = web.Application()
+        app.router.add_get('/', handle)
+        async with TestServer(app) as server:
+            url = str(server.make_url('/?product=hourly_height'))
+            monkeypatch.setattr(backfill.noaa_stations, 'build_base_url',
+                                lambda *args, **kwargs: url)
+            await backfill.run_backfill(work_db, Session, concurrency=2)
+
+    asyncio.run(run())
+
+    assert sorted(requests) == ['1', '3', '3', '3', '4', '4', '4']
+    status = dict(work_db.execute(
+        "SELECT station_id, status FROM work_units").fetchall())
+    assert status == {1: 'done', 3: 'done', 4: 'failed'}
+    assert [u[0] for u in backfill.exhausted_work_units(work_db)] == [4]
+    assert Session().query(HistoryLevelsDb).count() == 2
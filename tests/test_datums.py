@@ -0,0 +1,79 @@
+import asyncio
+
+import numpy as np
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import datums
+from datums import StationDatumDb
+
+
+def test_convert_levels_shifts_and_scales():
+    offsets = {1: 0.5, 3: -0.25}
+    converted = datums.convert_levels([3, 1, 2], [1.0, 1.0, 1.0], offsets)
+    np.testing.assert_allclose(converted[:2], [0.75, 1.5])
+    assert np.isnan(converted[2])
+
+    feet = datums.convert_levels([1], [0.3048], None, units='english')
+    np.testing.assert_allclose(feet, [1.0])
+
+
+def test_convert_levels_without_offsets():
+    assert np.isnan(datums.convert_levels([1], [1.0], {})).all()
+
+
+def test_load_offsets(sqlite_session):
+    session_db = sqlite_session(datums.DeclarativeBase)
+    session_db.add_all([
+        StationDatumDb(station_id=1, datum='MLLW', value=1.0),
+        StationDatumDb(station_id=1, datum='MSL', value=1.8),
+        StationDatumDb(station_id=2, datum='MLLW', value=0.5),
+    ])
+    session_db.commit()
+    assert datums.load_offsets(session_db, 'MLLW') is None
+    offsets = datums.load_offsets(session_db, 'MSL')
+    assert list(offsets) == [1]
+    np.testing.assert_allclose(offsets[1], -0.8)
+    assert datums.load_offsets(session_db, 'FOO') == {}
+
+
+def test_get_datums_per_station_errors(monkeypatch):
+    async def handle_datums(request):
+        station_id = int(request.match_info['station_id'])
+        if station_id == 1:
+            return web.json_response({'datums': [{'name': 'MSL', 'value': 1.8}]})
+        if station_id == 2:
+            return web.json_response({'datums': []})
+        if station_id == 3:
+            return web.Response(status=404)
+        if station_id == 4:
+            return web.Response(status=503)
+        return web.Response(text='not json')
+
+    async def get_datums():
+        app = web.Application()
+        app.router.add_get('/{station_id}', handle_datums)
+        async with TestServer(app) as server:
+            monkeypatch.setattr(datums, 'DATUMS_URL', str(server.make_url('/')) + '{}')
+            return await datums.get_datums_async([1, 2, 3, 4, 5])
+
+    # Failing stations are skipped without dropping the others
+    assert asyncio.run(get_datums()) == {1: {'MSL': 1.8}, 2: {}, 3: {}}
+
+
+def test_stations_without_datums_are_not_refetched(sqlite_session, monkeypatch):
+    session_db = sqlite_session(datums.DeclarativeBase)
+    fetched = []
+
+    async def get_datums_async(station_ids):
+        fetched.extend(station_ids)
+        return {station_id: {'MLLW': 1.0, 'MSL': 1.5} if station_id == 1 else {}
+                for station_id in station_ids if station_id != 3}
+
+    monkeypatch.setattr(datums, 'get_datums_async', get_datums_async)
+    assert datums.refresh_datums(session_db, [1, 2, 3]) == 2
+    assert datums.refresh_datums(session_db, [1, 2, 3]) == 0
+    assert fetched == [1, 2, 3, 3]
+    offsets = datums.load_offsets(session_db, 'MSL')
+    assert offsets == {1: -0.5}
+    assert datums.load_offsets(session_db, datums.NO_DATUMS) == {}
@@ -0,0 +1,116 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from sqlalchemy.pool import StaticPool
+from sqlalchemy import create_engine
+
+import fingerprints
+import rollups
+import windy_async
+import windy_bbox
+from fingerprints import FingerprintDb, FingerprintStore
+from windy_bbox import WaterLevelsDb
+
+
+BEGIN = datetime(2022, 1, 28, 10, 0)
+
+
+def sos_csv(levels_by_station, begin=BEGIN):
+    rows = ['station_id,sensor_id,latitude,longitude,date_time,level,datum_id,position']
+    for station_id, levels in levels_by_station.items():
+        for i, level in enumerate(levels):
+            stamp = (begin + timedelta(minutes=6 * i)).strftime('%Y-%m-%dT%H:%M:%SZ')
+            rows.append('urn:ioos:station:NOAA.NOS.CO-OPS:{0},'
+                        'urn:ioos:sensor:NOAA.NOS.CO-OPS:{0}:A1,0,0,{1},{2:.3f},'
+                        'urn:ogc:def:datum:epsg::5103,0.000'.format(station_id, stamp, level))
+    return '\n'.join(rows) + '\n'
+
+
+def test_write_changed_rows(sqlite_session):
+    session_db = sqlite_session(windy_bbox.DeclarativeBase)
+    session_db.add_all([
+        WaterLevelsDb(station_id=1, date_time=BEGIN, water_level=1.0),
+        WaterLevelsDb(station_id=1, date_time=BEGIN, water_level=1.0),
+        WaterLevelsDb(station_id=1, date_time=BEGIN + timedelta(minutes=6),
+                      water_level=2.0),
+    ])
+    session_db.commit()
+
+    written = fingerprints.write_changed_rows(session_db, WaterLevelsDb, 'water_level', {
+        (1, BEGIN): 1.0004,
+        (1, BEGIN + timedelta(minutes=6)): 2.5,
+        (1, BEGIN + timedelta(minutes=12)): 3.0,
+    })
+    session_db.commit()
+
+    assert written == [(1, BEGIN + timedelta(minutes=6), 2.5),
+                       (1, BEGIN + timedelta(minutes=12), 3.0)]
+    stored = session_db.query(WaterLevelsDb.date_time, WaterLevelsDb.water_level).order_by(
+        WaterLevelsDb.date_time).all()
+    assert [(d, float(v)) for d, v in stored] == [
+        (BEGIN, 1.0), (BEGIN + timedelta(minutes=6), 2.5),
+        (BEGIN + timedelta(minutes=12), 3.0)]
+
+
+def test_store_keeps_only_requested_windows(sqlite_session):
+    session_db = sqlite_session(fingerprints.DeclarativeBase)
+    store = FingerprintStore(session_db, 'water_level', ['2022-01-28T09', '2022-01-28T10'])
+    store.remember(1, 'a', '2022-01-28T09')
+    store.remember(1, 'b', '2022-01-28T10')
+    assert not store.is_unchanged(1, 'a', '2022-01-28T09')
+    store.commit()
+
+    store = FingerprintStore(session_db, 'water_level', ['2022-01-28T10', '2022-01-28T11'])
+    assert store.is_unchanged(1, 'b', '2022-01-28T10')
+    assert not store.is_unchanged(1, 'a', '2022-01-28T10')
+    store.commit()
+    assert [w for w, in session_db.query(FingerprintDb.window)] == ['2022-01-28T10']
+
+
+def test_closed_hours_are_skipped(monkeypatch):
+    engine = create_engine('sqlite://', poolclass=StaticPool)
+    for base in (windy_bbox.DeclarativeBase, rollups.DeclarativeBase,
+                 fingerprints.DeclarativeBase):
+        base.metadata.create_all(engine)
+    monkeypatch.setattr(windy_bbox, 'open_db', lambda: engine)
+    monkeypatch.setattr(windy_bbox.ring_buffer, 'put_rows', lambda *args: 0)
+
+    # Ten rows close the 10:00 hour, the 11:00 hour is still filling
+    first = windy_bbox.put_water_levels_to_db(
+        sos_csv({1: [1.0] * 12, 2: [2.0] * 12}), skip_unchanged=True)
+    assert len(first) == 24
+    second = windy_bbox.put_water_levels_to_db(
+        sos_csv({1: [1.0] * 13, 2: [2.0] * 13}), skip_unchanged=True)
+    assert sorted((s, d.hour, d.minute) for s, d, _ in second) == [(1, 11, 12), (2, 11, 12)]
+
+    # A revised row of a closed hour is written again
+    third = windy_bbox.put_water_levels_to_db(
+        sos_csv({1: [1.5] + [1.0] * 12, 2: [2.0] * 13}), skip_unchanged=True)
+    assert [(s, d, v) for s, d, v in third] == [(1, BEGIN, 1.5)]
+
+
+def test_unchanged_payload_is_not_decoded(sqlite_session):
+    session_db = sqlite_session(fingerprints.DeclarativeBase)
+    unchanged = b'not json, must never be decoded'
+    store = FingerprintStore(session_db, 'predictions', 'window')
+    store.remember(1, fingerprints.payload_digest(unchanged))
+    store.commit()
+
+    async def handle(request):
+        if request.query['station'] == '1':
+            return web.Response(body=unchanged)
+        return web.json_response({'predictions': []})
+
+    async def fetch():
+        app = web.Application()
+        app.router.add_get('/', handle)
+        async with TestServer(app) as server:
+            tides = []
+            await windy_async.get_tide_async(
+                str(server.make_url('/?product=predictions')), [1, 2], tides, store)
+        return tides
+
+    tides = asyncio.run(fetch())
+    assert [t['station_id'] for t in tides] == [2]
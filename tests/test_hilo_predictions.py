@@ -0,0 +1,50 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import hilo_predictions
+import tide_predictions
+from hilo_predictions import HiloPredictionsDb
+
+
+BEGIN = datetime(2022, 1, 28)
+HALF_PERIOD = 6 * 3600
+
+
+def test_interpolate_extrema_half_cosine():
+    ext_ids = np.array([1, 1, 1], dtype=np.int64)
+    ext_seconds = np.array([0, HALF_PERIOD, 2 * HALF_PERIOD], dtype=np.int64)
+    ext_values = np.array([2.0, 0.0, 2.0])
+    seconds = np.array([0, HALF_PERIOD // 2, HALF_PERIOD, 2 * HALF_PERIOD,
+                        2 * HALF_PERIOD + 1, -1])
+    rebuilt = hilo_predictions.interpolate_extrema(
+        ext_ids, ext_seconds, ext_values, np.ones(len(seconds)), seconds)
+    np.testing.assert_allclose(rebuilt[:4], [2.0, 1.0, 0.0, 2.0], atol=1e-12)
+    assert np.isnan(rebuilt[4:]).all()
+
+
+def test_interpolate_extrema_keeps_stations_apart():
+    ext_ids = np.array([2, 1, 2, 1], dtype=np.int64)
+    ext_seconds = np.array([0, 0, HALF_PERIOD, HALF_PERIOD], dtype=np.int64)
+    ext_values = np.array([3.0, 1.0, 1.0, -1.0])
+    rebuilt = hilo_predictions.interpolate_extrema(
+        ext_ids, ext_seconds, ext_values,
+        np.array([1, 2, 3]), np.full(3, HALF_PERIOD // 2))
+    np.testing.assert_allclose(rebuilt[:2], [0.0, 2.0], atol=1e-12)
+    assert np.isnan(rebuilt[2])
+
+
+def test_reconstruct_predictions(sqlite_session):
+    session_db = sqlite_session(tide_predictions.DeclarativeBase,
+                                hilo_predictions.DeclarativeBase)
+    for i, (value, hi_lo) in enumerate([(2.0, 'H'), (0.0, 'L'), (2.0, 'H')]):
+        session_db.add(HiloPredictionsDb(
+            station_id=1, date_time=BEGIN + timedelta(hours=6 * i),
+            predicted_wl=value, hi_lo=hi_lo))
+    session_db.commit()
+
+    df = hilo_predictions.reconstruct_predictions(
+        session_db, [1], BEGIN, BEGIN + timedelta(hours=12),
+        step=timedelta(hours=3))
+    assert df.index.tolist() == [BEGIN + timedelta(hours=3 * i) for i in range(5)]
+    np.testing.assert_allclose(df['predicted_wl'], [2.0, 1.0, 0.0, 1.0, 2.0], atol=1e-12)
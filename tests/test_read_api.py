@@ -0,0 +1,250 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from aiohttp.test_utils import TestClient, TestServer
+from sqlalchemy import create_engine
+from sqlalchemy.pool import StaticPool
+
+import datums
+import fingerprints
+import hilo_predictions
+import read_api
+import rollups
+import tide_predictions
+import windy_bbox
+from datums import StationDatumDb
+from fingerprints import FingerprintDb
+from hilo_predictions import HiloPredictionsDb
+from read_api import HotCache
+from tide_predictions import PredictionsDb
+from windy_bbox import StationDb, WaterLevelsDb
+
+
+NOW = datetime(2022, 1, 28, 12, 0)
+
+
+def test_hot_cache_lru_and_ttl(monkeypatch):
+    clock = [100.0]
+    monkeypatch.setattr(read_api.time, 'monotonic', lambda: clock[0])
+    cache = HotCache(max_entries=2, ttl=10)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get('a')
+    cache.put('c', 3)
+    assert cache.get('b') is None and cache.get('a') == 1
+
+    clock[0] += 11
+    assert cache.get('a') is None and len(cache) == 1
+
+
+def test_update_latest_keeps_newest():
+    cache = HotCache()
+    cache.put(('latest', 1), (NOW - timedelta(minutes=12), 0.0))
+    cache.put(('latest', 2), read_api.NO_DATA)
+    cache.put(('latest', 3), (NOW, 3.0))
+    unknown = cache.update_latest([
+        (1, NOW, 1.0), (1, NOW - timedelta(minutes=6), 0.5), (2, NOW, 2.0),
+        # A revised older row of a cached and of an uncached station
+        (3, NOW - timedelta(minutes=6), 9.0), (4, NOW - timedelta(hours=1), 9.0),
+    ])
+    assert cache.get(('latest', 1)) == (NOW, 1.0)
+    assert cache.get(('latest', 2)) == (NOW, 2.0)
+    assert cache.get(('latest', 3)) == (NOW, 3.0)
+    assert unknown == [4] and cache.get(('latest', 4)) is None
+
+
+def make_engine():
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    for base in (windy_bbox.DeclarativeBase, tide_predictions.DeclarativeBase,
+                 rollups.DeclarativeBase, fingerprints.DeclarativeBase,
+                 datums.DeclarativeBase, hilo_predictions.DeclarativeBase):
+        base.metadata.create_all(engine)
+    return engine
+
+
+def run_requests(engine, monkeypatch, calls):
+    monkeypatch.setattr(datums, 'open_db', lambda: engine)
+
+    async def run():
+        app = read_api.make_app(with_ingest=False)
+        async with TestClient(TestServer(app)) as client:
+            return [await call(app, client) for call in calls]
+
+    return asyncio.run(run())
+
+
+def test_latest_caches_stations_without_data(monkeypatch):
+    engine = make_engine()
+    session_db = read_api.sessionmaker(bind=engine)()
+    session_db.add_all([
+        StationDb(id=1, station_name='a', latitude=10, longitude=20),
+        StationDb(id=2, station_name='b', latitude=11, longitude=21),
+        WaterLevelsDb(station_id=1, date_time=NOW, water_level=1.5),
+    ])
+    session_db.commit()
+    queried = []
+    query_latest = read_api.query_latest
+
+    def counting_query_latest(session_db, station_ids=None):
+        queried.append(station_ids)
+        return query_latest(session_db, station_ids)
+
+    monkeypatch.setattr(read_api, 'query_latest', counting_query_latest)
+
+    async def get_latest(app, client):
+        resp = await client.get('/latest')
+        return (await resp.json())['data']
+
+    first, second = run_requests(engine, monkeypatch, [get_latest, get_latest])
+    assert first == second == [{'station_id': 1, 't': '2022-01-28 12:00', 'v': 1.5}]
+    assert queried == [[1, 2]]
+
+
+def test_rewritten_predictions_are_evicted(monkeypatch):
+    engine = make_engine()
+    session_db = read_api.sessionmaker(bind=engine)()
+    session_db.add_all([
+        PredictionsDb(station_id=1, date_time=NOW, predicted_wl=1.0),
+        FingerprintDb(station_id=1, product='predictions', window='w',
+                      digest='a', updated_at=NOW),
+    ])
+    session_db.commit()
+
+    def rewrite():
+        session_db.query(PredictionsDb).update({'predicted_wl': 2.0})
+        session_db.query(FingerprintDb).update(
+            {'updated_at': NOW + timedelta(minutes=1)})
+        session_db.commit()
+
+    async def get_prediction(app, client):
+        resp = await client.get('/predictions/1?begin_date=2022-01-28T00:00'
+                                '&end_date=2022-01-29T00:00')
+        return (await resp.json())['predictions'][0]['v']
+
+    async def check(app, client):
+        await read_api.invalidate_predictions(app)
+
+    async def rewrite_and_check(app, client):
+        rewrite()
+        await read_api.invalidate_predictions(app)
+
+    results = run_requests(engine, monkeypatch, [
+        check, get_prediction, rewrite_and_check, get_prediction])
+    assert results[1] == 1.0 and results[3] == 2.0
+
+
+def test_predictions_beyond_stored_window_come_from_extrema(monkeypatch):
+    engine = make_engine()
+    session_db = read_api.sessionmaker(bind=engine)()
+    session_db.add_all([
+        PredictionsDb(station_id=1, date_time=NOW, predicted_wl=1.0),
+        PredictionsDb(station_id=1, date_time=NOW + timedelta(minutes=6),
+                      predicted_wl=1.1),
+        # Extrema 12:00 apart, the first one off the 6-minute grid
+        HiloPredictionsDb(station_id=1, hi_lo='L', predicted_wl=0.0,
+                          date_time=NOW - timedelta(hours=12, minutes=3)),
+        HiloPredictionsDb(station_id=1, hi_lo='H', predicted_wl=2.0,
+                          date_time=NOW - timedelta(minutes=3)),
+        HiloPredictionsDb(station_id=1, hi_lo='L', predicted_wl=0.0,
+                          date_time=NOW + timedelta(hours=11, minutes=57)),
+    ])
+    session_db.commit()
+
+    async def get_predictions(app, client):
+        resp = await client.get('/predictions/1?begin_date=2022-01-28T05:57'
+                                '&end_date=2022-01-28T12:18')
+        return (await resp.json())['predictions']
+
+    predictions, = run_requests(engine, monkeypatch, [get_predictions])
+    times = [p['t'] for p in predictions]
+    assert times[0] == '2022-01-28 06:00' and times[-1] == '2022-01-28 12:18'
+    assert len(times) == len(set(times)) == 64
+    by_time = dict(zip(times, [p['v'] for p in predictions]))
+    # Stored values win inside the stored window
+    assert by_time['2022-01-28 12:00'] == 1.0
+    assert by_time['2022-01-28 12:06'] == 1.1
+    # About half way between the low and the high
+    assert abs(by_time['2022-01-28 06:00'] - 1.0) < 0.05
+    assert 0.0 < by_time['2022-01-28 12:18'] < 2.0
+
+
+def test_unknown_datum_is_rejected_and_not_cached(monkeypatch):
+    engine = make_engine()
+    session_db = read_api.sessionmaker(bind=engine)()
+    session_db.add_all([
+        StationDb(id=1, station_name='a', latitude=10, longitude=20),
+        WaterLevelsDb(station_id=1, date_time=NOW, water_level=1.5),
+    ])
+    session_db.commit()
+
+    async def get_msl(app, client):
+        resp = await client.get('/latest?datum=MSL')
+        return resp.status, (await resp.json())['data'] if resp.status == 200 else None
+
+    async def get_foo(app, client):
+        return (await client.get('/latest?datum=FOO')).status, None
+
+    async def fill_datums(app, client):
+        session_db.add_all([
+            StationDatumDb(station_id=1, datum='MLLW', value=1.0),
+            StationDatumDb(station_id=1, datum='MSL', value=1.5),
+        ])
+        session_db.commit()
+
+    results = run_requests(engine, monkeypatch, [
+        get_msl, fill_datums, get_msl, get_foo])
+    assert results[0] == (400, None)
+    assert results[2] == (200, [{'station_id': 1, 't': '2022-01-28 12:00', 'v': 1.0}])
+    assert results[3] == (400, None)
+
+
+def test_datum_refresh_drops_cached_offsets(monkeypatch):
+    engine = make_engine()
+    session_db = read_api.sessionmaker(bind=engine)()
+    session_db.add(StationDb(id=1, station_name='a', latitude=10, longitude=20))
+    session_db.commit()
+    refreshed = []
+
+    def refresh_datums(session_db, station_ids):
+        refreshed.append(station_ids)
+        return len(station_ids)
+
+    monkeypatch.setattr(datums, 'refresh_datums', refresh_datums)
+
+    async def refresh(app, client):
+        app['cache'].put(('datum_offsets', 'MSL'), {1: 0.5})
+        await read_api.refresh_station_datums(app)
+        return app['cache'].get(('datum_offsets', 'MSL'))
+
+    assert run_requests(engine, monkeypatch, [refresh]) == [None]
+    assert refreshed == [[1]]
+
+
+def test_ingest_loop_checks_db_for_uncached_stations(monkeypatch):
+    engine = make_engine()
+    session_db = read_api.sessionmaker(bind=engine)()
+    session_db.add_all([
+        StationDb(id=1, station_name='a', latitude=10, longitude=20),
+        WaterLevelsDb(station_id=1, date_time=NOW, water_level=1.5),
+        WaterLevelsDb(station_id=1, date_time=NOW - timedelta(hours=1),
+                      water_level=9.0),
+    ])
+    session_db.commit()
+    # The ingest revised only an older row of the station
+    monkeypatch.setattr(windy_bbox, 'get_water_levels_from_noaa',
+                        lambda: [(1, NOW - timedelta(hours=1), 9.0)])
+    monkeypatch.setattr(read_api, 'INGEST_PERIOD', 0)
+
+    async def run_one_cycle(app, client):
+        task = read_api.asyncio.ensure_future(read_api.ingest_loop(app))
+        while app['cache'].get(('latest', 1)) is None:
+            await read_api.asyncio.sleep(0.01)
+        task.cancel()
+        return app['cache'].get(('latest', 1))
+
+    async def no_refresh(app):
+        pass
+
+    monkeypatch.setattr(read_api, 'refresh_station_datums', no_refresh)
+    assert run_requests(engine, monkeypatch, [run_one_cycle]) == [(NOW, 1.5)]
@@ -0,0 +1,120 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import residuals
+import tide_predictions
+import windy_bbox
+from residuals import ResidualsDb
+from tide_predictions import PredictionsDb
+from windy_bbox import WaterLevelsDb
+
+
+NOW = datetime(2022, 1, 28, 12, 0)
+TICK = timedelta(minutes=6)
+
+
+def make_db(sqlite_session):
+    return sqlite_session(windy_bbox.DeclarativeBase,
+                          tide_predictions.DeclarativeBase,
+                          residuals.DeclarativeBase)
+
+
+def add_series(session_db, model, column, station_id, begin, values):
+    for i, value in enumerate(values):
+        session_db.add(model(station_id=station_id, date_time=begin + i * TICK,
+                             **{column: value}))
+    session_db.commit()
+
+
+def test_rolling_mean_std_skips_nan():
+    grid = np.array([[1.0, np.nan, 3.0, 5.0]])
+    mean, std = residuals.rolling_mean_std(grid, window=2)
+    np.testing.assert_allclose(mean, [[1.0, 1.0, 3.0, 4.0]])
+    np.testing.assert_allclose(std, [[0.0, 0.0, 0.0, 1.0]])
+
+
+def test_rolling_mean_std_empty_window_is_nan():
+    mean, std = residuals.rolling_mean_std(np.array([[np.nan, 2.0]]), window=1)
+    assert np.isnan(mean[0, 0]) and np.isnan(std[0, 0])
+    assert mean[0, 1] == 2.0
+
+
+def test_compute_residuals_flags():
+    observed = np.array([[1.0, 1.5, 0.5]])
+    predicted = np.array([[1.0, 1.0, 1.0]])
+    residual, _, _, flags = residuals.compute_residuals(observed, predicted, 2)
+    np.testing.assert_allclose(residual, [[0.0, 0.5, -0.5]])
+    assert flags[0, 0] == 0
+    assert flags[0, 1] == residuals.FLAG_POSITIVE_SURGE | residuals.FLAG_RATE_OF_CHANGE
+    assert flags[0, 2] == residuals.FLAG_NEGATIVE_SURGE | residuals.FLAG_RATE_OF_CHANGE
+
+
+def test_update_residuals_appends_only_new_ticks(sqlite_session):
+    session_db = make_db(sqlite_session)
+    begin = NOW - 9 * TICK
+    add_series(session_db, WaterLevelsDb, 'water_level', 1, begin, [1.0] * 10)
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, begin, [0.5] * 10)
+
+    assert len(residuals.update_residuals(session_db, now=NOW)) == 10
+    add_series(session_db, WaterLevelsDb, 'water_level', 1, NOW + TICK, [1.0])
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, NOW + TICK, [0.5])
+    new = residuals.update_residuals(session_db, now=NOW + TICK)
+    assert [r['date_time'] for r in new] == [NOW + TICK]
+
+
+def test_update_residuals_waits_for_missing_prediction(sqlite_session):
+    session_db = make_db(sqlite_session)
+    begin = NOW - 4 * TICK
+    add_series(session_db, WaterLevelsDb, 'water_level', 1, begin, [1.0] * 5)
+    # The prediction of the third tick has not arrived yet
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, begin, [0.5] * 2)
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, begin + 3 * TICK,
+               [0.5] * 2)
+
+    assert len(residuals.update_residuals(session_db, now=NOW)) == 2
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, begin + 2 * TICK,
+               [0.5])
+    new = residuals.update_residuals(session_db, now=NOW)
+    assert [r['date_time'] for r in new] == [begin + i * TICK for i in (2, 3, 4)]
+
+
+def test_update_residuals_caps_lookback_of_stale_station(sqlite_session,
+                                                         monkeypatch):
+    session_db = make_db(sqlite_session)
+    loaded_begins = []
+    load_series = residuals.load_series
+
+    def recording_load_series(session_db, model, value_column, begin, end):
+        loaded_begins.append(begin)
+        return load_series(session_db, model, value_column, begin, end)
+
+    monkeypatch.setattr(residuals, 'load_series', recording_load_series)
+    stale = NOW - timedelta(days=30)
+    session_db.add(ResidualsDb(station_id=2, date_time=stale, residual=0.0))
+    add_series(session_db, WaterLevelsDb, 'water_level', 2,
+               stale - 5 * TICK, [1.0] * 5)
+    add_series(session_db, WaterLevelsDb, 'water_level', 1, NOW - TICK, [1.0] * 2)
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, NOW - TICK, [0.5] * 2)
+
+    new = residuals.update_residuals(session_db, now=NOW)
+    assert {r['station_id'] for r in new} == {1}
+    assert min(loaded_begins) >= (NOW - residuals.MAX_LOOKBACK
+                                  - residuals.ROLLING_TICKS * TICK)
+    assert residuals.get_watermarks(session_db)[1] == NOW
+
+
+def test_update_residuals_skips_ticks_before_purged_predictions(sqlite_session):
+    session_db = make_db(sqlite_session)
+    midnight = NOW.replace(hour=0)
+    begin = NOW - timedelta(hours=30)
+    add_series(session_db, WaterLevelsDb, 'water_level', 1, begin,
+               [1.0] * (30 * 10 + 1))
+    # tide_predictions.py keeps predictions from midnight on only
+    add_series(session_db, PredictionsDb, 'predicted_wl', 1, midnight,
+               [0.5] * (36 * 10))
+
+    new = residuals.update_residuals(session_db, now=NOW)
+    assert new[0]['date_time'] == midnight
+    assert new[-1]['date_time'] == NOW
+    assert residuals.update_residuals(session_db, now=NOW) == []
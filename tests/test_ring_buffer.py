@@ -0,0 +1,142 @@
+import multiprocessing
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import fingerprints
+import ring_buffer
+import rollups
+import water_levels
+import windy_bbox
+from ring_buffer import RingBuffer
+from windy_bbox import StationDb, WaterLevelsDb
+
+
+BEGIN = datetime(2022, 1, 28, 12, 0)
+TICK = timedelta(minutes=6)
+
+
+def test_write_and_window_across_wrapped_slots(tmp_path):
+    ring = RingBuffer.create(str(tmp_path / 'ring'), [2, 1], n_slots=4)
+    date_times = [BEGIN + i * TICK for i in range(6)]
+    assert ring.write([1] * 6, date_times, np.arange(6.0)) == 6
+
+    times, values = ring.window(1)
+    assert times.tolist() == date_times[2:]
+    np.testing.assert_allclose(values, [2.0, 3.0, 4.0, 5.0])
+    # Wrapped-over samples are gone, not read back from their old slot
+    _, older = ring.window(1, n_ticks=4, end_tick=ring.latest_tick() - 4)
+    assert np.isnan(older).all()
+
+    # An older sample never overwrites the newer one in its slot
+    assert ring.write([1, 3], [date_times[1], BEGIN], [9.0, 9.0]) == 0
+    station_ids, snapshot = ring.snapshot()
+    assert station_ids.tolist() == [1, 2]
+    assert snapshot[0] == 5.0 and np.isnan(snapshot[1])
+
+
+def test_rebuild_keeps_samples_of_kept_stations(tmp_path):
+    path = str(tmp_path / 'ring')
+    ring, unseeded = ring_buffer.open_ring([1, 2], path)
+    assert unseeded.tolist() == [1, 2]
+    ring.write([1, 2], [BEGIN, BEGIN], [1.0, 2.0])
+    del ring
+
+    ring, unseeded = ring_buffer.open_ring([2, 3], path)
+    assert unseeded.tolist() == [3]
+    assert ring.station_ids.tolist() == [2, 3]
+    np.testing.assert_allclose(ring.snapshot()[1][0], 2.0)
+    assert ring_buffer.open_ring([2, 3], path)[1].size == 0
+
+
+def make_session(monkeypatch):
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    for base in (windy_bbox.DeclarativeBase, rollups.DeclarativeBase,
+                 fingerprints.DeclarativeBase):
+        base.metadata.create_all(engine)
+    monkeypatch.setattr(water_levels, 'open_db', lambda: engine)
+    return sessionmaker(bind=engine)()
+
+
+def test_new_ring_is_seeded_from_db(tmp_path, monkeypatch):
+    session_db = make_session(monkeypatch)
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    session_db.add_all([StationDb(id=1), StationDb(id=2)])
+    session_db.add_all([
+        WaterLevelsDb(station_id=1, date_time=now - timedelta(hours=2), water_level=1.0),
+        WaterLevelsDb(station_id=2, date_time=now - timedelta(days=10), water_level=2.0),
+    ])
+    session_db.commit()
+
+    path = str(tmp_path / 'ring')
+    ring_buffer.put_rows(session_db, [(2, now, 3.0)], path)
+    ring = RingBuffer(path)
+    _, values = ring.window(1)
+    np.testing.assert_allclose(values[~np.isnan(values)], [1.0])
+    _, values = ring.window(2)
+    np.testing.assert_allclose(values[~np.isnan(values)], [3.0])
+
+
+def _write_station(path, station_ids, station_id):
+    # Every writer sees another station list, each write rebuilds the ring
+    for i in range(20):
+        with ring_buffer.ring_lock(path):
+            ring, _ = ring_buffer.open_ring(station_ids + [1000 + i], path)
+            ring.write([station_id], [BEGIN + i * TICK], [float(i)])
+
+
+def test_concurrent_writers_lose_no_samples(tmp_path):
+    path = str(tmp_path / 'ring')
+    station_ids = [1, 2, 3, 4]
+    writers = [multiprocessing.Process(target=_write_station,
+                                       args=(path, station_ids, s))
+               for s in station_ids]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+
+    ring = RingBuffer(path)
+    for station_id in station_ids:
+        _, values = ring.window(station_id, n_ticks=20, end_tick=ring.latest_tick())
+        np.testing.assert_allclose(values, np.arange(20.0))
+
+
+def test_water_levels_sync_writes_the_ring(tmp_path, monkeypatch):
+    session_db = make_session(monkeypatch)
+    session_db.add_all([StationDb(id=1), StationDb(id=2)])
+    session_db.commit()
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    tide_data = pd.DataFrame(
+        {'station_id': [1, 2, 2], 'water_level': [1.5, 2.5, np.nan]},
+        index=pd.DatetimeIndex([now, now - TICK, now], name='date_time'))
+    monkeypatch.setattr(water_levels.noaa_stations, 'get_data',
+                        lambda *args, **kwargs: tide_data)
+    path = str(tmp_path / 'ring')
+    put_rows = ring_buffer.put_rows
+    monkeypatch.setattr(water_levels.ring_buffer, 'put_rows',
+                        lambda session_db, new_rows: put_rows(session_db, new_rows, path))
+
+    assert len(water_levels.put_water_levels()) == 2
+    assert water_levels.put_water_levels() == []
+    ring = RingBuffer(path)
+    for station_id, level in ((1, 1.5), (2, 2.5)):
+        _, values = ring.window(station_id)
+        np.testing.assert_allclose(values[~np.isnan(values)], [level])
+
+
+def test_future_stamped_station_does_not_move_defaults(tmp_path):
+    ring = RingBuffer.create(str(tmp_path / 'ring'), [1, 2], n_slots=20)
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    ring.write([1, 2], [now, now + timedelta(days=2)], [1.0, 9.0])
+
+    assert ring.latest_tick() == ring_buffer.to_ticks(now)
+    station_ids, snapshot = ring.snapshot()
+    np.testing.assert_allclose(snapshot[0], 1.0)
+    _, values = ring.window(1)
+    assert values[-1] == 1.0
@@ -0,0 +1,93 @@
+from datetime import date, datetime, timedelta
+
+import numpy as np
+
+import fingerprints
+import rollups
+import windy_bbox
+from windy_bbox import WaterLevelsDb
+
+
+def test_aggregate_buckets():
+    station_ids = np.array([2, 1, 1, 1, 1], dtype=np.int64)
+    seconds = np.array([0, 3600, 0, 1800, 600], dtype=np.int64)
+    values = np.array([5.0, 4.0, 1.0, np.nan, 3.0])
+    buckets = rollups.aggregate_buckets(station_ids, seconds, values, 3600)
+
+    assert buckets['station_id'].tolist() == [1, 1, 2]
+    assert buckets['bucket'].tolist() == [0, 3600, 0]
+    assert buckets['count'].tolist() == [2, 1, 1]
+    np.testing.assert_allclose(buckets['mean'], [2.0, 4.0, 5.0])
+    assert buckets['min'].tolist() == [1.0, 4.0, 5.0]
+    assert buckets['max'].tolist() == [3.0, 4.0, 5.0]
+    assert buckets['min_time'].tolist() == [0, 3600, 0]
+    assert buckets['max_time'].tolist() == [600, 3600, 0]
+
+
+def test_aggregate_buckets_all_nan():
+    buckets = rollups.aggregate_buckets(
+        np.array([1], dtype=np.int64), np.array([0], dtype=np.int64),
+        np.array([np.nan]), 3600)
+    assert len(buckets['station_id']) == 0
+
+
+def write(session_db, measures):
+    revised = []
+    rows = fingerprints.write_changed_rows(
+        session_db, WaterLevelsDb, 'water_level', measures, revised)
+    session_db.commit()
+    rollups.update_rollups(session_db, WaterLevelsDb, 'water_level',
+                           'water_level', rows, revised)
+
+
+def test_new_rows_are_merged_without_rescanning(sqlite_session, monkeypatch):
+    session_db = sqlite_session(windy_bbox.DeclarativeBase,
+                                rollups.DeclarativeBase)
+    rescans = []
+    monkeypatch.setattr(rollups, '_rescan_buckets',
+                        lambda *args: rescans.append(args))
+    begin = datetime(2022, 1, 28, 10, 0)
+    write(session_db, {(1, begin + timedelta(minutes=6 * i)): float(i)
+                       for i in range(5)})
+    write(session_db, {(1, begin + timedelta(minutes=6 * i)): float(i)
+                       for i in range(5, 20)})
+
+    assert rescans == []
+    hourly = rollups.get_hourly(session_db, 1, 'water_level',
+                                begin, begin + timedelta(hours=2))
+    assert hourly['count'].tolist() == [10, 10]
+    assert hourly['mean'].tolist() == [4.5, 14.5]
+    assert hourly['min'].tolist() == [0.0, 10.0]
+    daily = rollups.get_daily(session_db, 1, 'water_level',
+                              date(2022, 1, 28), date(2022, 1, 28))
+    assert daily['high'].tolist() == [19.0]
+    assert daily['low_time'].tolist() == [begin]
+
+
+def test_revised_row_rescans_its_buckets(sqlite_session):
+    session_db = sqlite_session(windy_bbox.DeclarativeBase,
+                                rollups.DeclarativeBase)
+    begin = datetime(2022, 1, 28, 10, 0)
+    write(session_db, {(1, begin + timedelta(minutes=6 * i)): float(i)
+                       for i in range(20)})
+
+    # A verified value replaces the preliminary one of a stored tick
+    late = begin + timedelta(minutes=30)
+    write(session_db, {(1, late): 50.0})
+    assert session_db.query(WaterLevelsDb).count() == 20
+
+    hourly = rollups.get_hourly(session_db, 1, 'water_level',
+                                begin, begin + timedelta(hours=2))
+    assert hourly['count'].tolist() == [10, 10]
+    assert hourly['max'].tolist() == [50.0, 19.0]
+    daily = rollups.get_daily(session_db, 1, 'water_level',
+                              date(2022, 1, 28), date(2022, 1, 28))
+    assert daily['high'].tolist() == [50.0]
+    assert daily['high_time'].tolist() == [late]
+    assert daily['low'].tolist() == [0.0]
+
+    # Revising the extreme back down is only possible by rescanning
+    write(session_db, {(1, late): 5.0})
+    hourly = rollups.get_hourly(session_db, 1, 'water_level',
+                                begin, begin + timedelta(hours=2))
+    assert hourly['max'].tolist() == [9.0, 19.0]
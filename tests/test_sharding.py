@@ -0,0 +1,91 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+import ring_buffer
+import rollups
+import sharding
+import windy_bbox
+from sharding import HashRing, StationLeaseDb
+from windy_bbox import StationDb
+
+
+STATIONS = list(range(8410000, 8410300))
+
+
+def test_ring_moves_only_the_leaving_workers_stations():
+    before = HashRing(['a', 'b', 'c', 'd'])
+    after = HashRing(['a', 'b', 'c'])
+    shares = [len(before.assign(STATIONS, w)) for w in 'abcd']
+    assert sum(shares) == len(STATIONS)
+    assert min(shares) > len(STATIONS) / 4 / 2
+
+    moved = [s for s in STATIONS if before.owner(s) != after.owner(s)]
+    assert moved and all(before.owner(s) == 'd' for s in moved)
+
+
+def test_claim_waits_for_live_lease_and_takes_expired(sqlite_session):
+    lease_db = sqlite_session(sharding.DeclarativeBase)
+    assert sharding.claim_stations(lease_db, 'a', [1, 2]) == [1, 2]
+    # b owns the stations after a rebalance, a's leases are still live
+    assert sharding.claim_stations(lease_db, 'b', [1, 2]) == []
+
+    lease_db.query(StationLeaseDb).filter(StationLeaseDb.station_id == 1).update(
+        {'expires_at': datetime.utcnow() - timedelta(seconds=1)})
+    lease_db.commit()
+    assert sharding.claim_stations(lease_db, 'b', [1, 2]) == [1]
+    # a releases what it no longer owns
+    assert sharding.claim_stations(lease_db, 'a', []) == []
+    assert sharding.claim_stations(lease_db, 'b', [1, 2]) == [1, 2]
+
+
+def test_worker_leases_outlive_long_jobs_and_failures(monkeypatch, tmp_path):
+    engine = create_engine('sqlite://', poolclass=StaticPool,
+                           connect_args={'check_same_thread': False})
+    windy_bbox.DeclarativeBase.metadata.create_all(engine)
+    session_db = sessionmaker(bind=engine)()
+    session_db.add_all([StationDb(id=s) for s in STATIONS[:20]])
+    session_db.commit()
+    monkeypatch.setattr(windy_bbox, 'open_db', lambda: engine)
+    monkeypatch.setattr(sharding, 'LEASE_TTL', timedelta(seconds=2))
+    monkeypatch.setattr(sharding, 'HEARTBEAT_SECONDS', 0.2)
+    monkeypatch.setattr(sharding, 'CYCLE_SECONDS', 0.1)
+
+    lease_url = 'sqlite:///{}'.format(tmp_path / 'leases.sqlite')
+    LeaseSession = sessionmaker(bind=sharding.open_lease_db(lease_url))
+    seen = []
+
+    def job(session_db, claimed):
+        if not seen:
+            seen.append('failed')
+            raise ValueError('NOAA is down')
+        # Longer than the lease TTL, the heartbeat thread keeps it alive
+        sharding.time.sleep(2.5)
+        seen.append(sharding.live_workers(LeaseSession()))
+
+    sharding.run_worker('w1', lease_url, job=job, cycles=2)
+    assert seen == ['failed', ['w1']]
+    assert sharding.live_workers(LeaseSession()) == []
+
+
+def test_ingest_drops_gaps(sqlite_session, monkeypatch, tmp_path):
+    session_db = sqlite_session(windy_bbox.DeclarativeBase, rollups.DeclarativeBase)
+    session_db.add(StationDb(id=1))
+    session_db.commit()
+    now = datetime.utcnow().replace(second=0, microsecond=0)
+    tide_data = pd.DataFrame(
+        {'station_id': [1, 1], 'water_level': [1.5, np.nan]},
+        index=pd.DatetimeIndex([now - timedelta(minutes=6), now], name='date_time'))
+    monkeypatch.setattr(sharding.noaa_stations, 'get_data',
+                        lambda *args, **kwargs: tide_data)
+    put_rows = ring_buffer.put_rows
+    monkeypatch.setattr(sharding.ring_buffer, 'put_rows',
+                        lambda session_db, new_rows: put_rows(
+                            session_db, new_rows, str(tmp_path / 'ring')))
+
+    assert [v for _, _, v in sharding.ingest_water_levels(session_db, [1])] == [1.5]
+    assert sharding.ingest_water_levels(session_db, [1]) == []
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import residuals
+import tiles
+import windy_bbox
+from residuals import ResidualsDb
+from windy_bbox import StationDb
+
+
+NOW = datetime(2022, 1, 28, 12, 0)
+GRID = tiles.Grid('test', 30.0, 32.0, -80.0, -78.0, 0.5)
+
+
+def test_interpolate_weights_and_nodata():
+    index = {
+        'neighbors': np.array([[0, 1], [0, 1], [1, 2]], dtype=np.int32),
+        'weights': np.array([[1.0, 1.0], [3.0, 1.0], [0.0, 0.0]], dtype=np.float32),
+    }
+    field = tiles.interpolate(index, np.array([1.0, 3.0, 5.0], dtype=np.float32))
+    np.testing.assert_allclose(field[:2], [2.0, 1.5])
+    assert np.isnan(field[2])
+
+    field = tiles.interpolate(index, np.array([1.0, np.nan, 5.0], dtype=np.float32))
+    np.testing.assert_allclose(field[:2], [1.0, 1.0])
+
+
+def test_quantize_residual_field():
+    quantized = tiles.quantize(np.array([-2.0, 0.0, 2.0, 9.0, np.nan]),
+                               tiles.FIELDS['residual'])
+    assert quantized.tolist() == [0, 127, 254, 254, tiles.NODATA_UINT8]
+
+
+def test_incremental_tile_equals_full_recompute(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, 'TILES_DIR', str(tmp_path))
+    field = tiles.FIELDS['water_level']
+    station_ids = np.array([1, 2, 3])
+    index = tiles.build_neighbor_index(
+        GRID, station_ids, [30.2, 31.0, 31.8], [-79.8, -79.0, -78.2], k=2)
+
+    tiles.write_tile(GRID, field, NOW, index, [1.0, 2.0, 3.0])
+    changed = [1.0, 2.5, np.nan]
+    incremental = np.load(tiles.write_tile(
+        GRID, field, NOW + timedelta(minutes=6), index, changed))
+    full = tiles.quantize(tiles.interpolate(index, np.array(changed, dtype=np.float32)),
+                          field).reshape(tiles.grid_shape(GRID))
+    np.testing.assert_array_equal(incremental, full)
+
+
+def test_latest_station_values_takes_each_stations_newest(sqlite_session):
+    session_db = sqlite_session(windy_bbox.DeclarativeBase,
+                                residuals.DeclarativeBase)
+    session_db.add_all([StationDb(id=s, latitude=30 + s, longitude=-80)
+                        for s in (1, 2, 3, 4)])
+    session_db.add_all([
+        ResidualsDb(station_id=1, date_time=NOW, residual=0.1),
+        ResidualsDb(station_id=1, date_time=NOW - timedelta(minutes=6), residual=9.0),
+        # Station 2 reports one tick late, station 3 stopped a day ago
+        ResidualsDb(station_id=2, date_time=NOW - timedelta(minutes=6), residual=0.2),
+        ResidualsDb(station_id=3, date_time=NOW - timedelta(days=1), residual=0.3),
+        # Station 4 runs ahead of the requested timestep
+        ResidualsDb(station_id=4, date_time=NOW + timedelta(hours=2), residual=0.4),
+    ])
+    session_db.commit()
+
+    station_ids, lats, _, values = tiles.latest_station_values(
+        session_db, 'residual', NOW)
+    assert station_ids.tolist() == [1, 2, 3, 4]
+    assert lats.tolist() == [31.0, 32.0, 33.0, 34.0]
+    np.testing.assert_allclose(values[:2], [0.1, 0.2])
+    assert np.isnan(values[2:]).all()
+
+
+def test_rewrite_replaces_tile_and_prunes(tmp_path, monkeypatch):
+    monkeypatch.setattr(tiles, 'TILES_DIR', str(tmp_path))
+    field = tiles.FIELDS['water_level']
+    index = tiles.build_neighbor_index(
+        GRID, np.array([1, 2]), [30.5, 31.5], [-79.5, -78.5], k=2)
+
+    path = tiles.write_tile(GRID, field, NOW, index, [1.0, 1.0])
+    mapped = np.load(path, mmap_mode='r')
+    tiles.write_tile(GRID, field, NOW, index, [2.0, 2.0])
+    # A reader keeps its consistent copy, the new tile is a new file
+    assert np.nanmax(mapped) == 1.0
+    assert np.nanmax(np.load(path)) == 2.0
+
+    # A tile left without station values is recomputed from scratch
+    tiles.os.remove(tiles.stations_path(path))
+    later = tiles.write_tile(GRID, field, NOW + timedelta(minutes=6), index, [3.0, 3.0])
+    assert np.nanmax(np.load(later)) == 3.0
+
+    tiles.prune_tiles(GRID, field, keep=1)
+    assert sorted(p.name for p in (tmp_path / 'test' / 'water_level').iterdir()) == [
+        '20220128T1206.npy', '20220128T1206.stations.npy']
@@ -0,0 +1,15 @@
+import numpy as np
+
+
+TICK_SECONDS = 360  # NOAA 6-minute sampling interval
+
+
+def to_ticks(date_times):
+    """Round datetimes to the index of the nearest 6-minute tick."""
+    seconds = np.asarray(date_times, dtype='datetime64[s]').astype(np.int64)
+    return (seconds + TICK_SECONDS // 2) // TICK_SECONDS
+
+
+def from_ticks(ticks):
+    seconds = np.asarray(ticks, dtype=np.int64) * TICK_SECONDS
+    return seconds.astype('datetime64[s]')
@@ -6,6 +6,8 @@ from sqlalchemy import Column, ForeignKey, Integer, Numeric, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
 import noaa_stations
+import rollups
+import fingerprints
 
 
 def open_db():
@@ -18,6 +20,8 @@ def open_db():
     windy_db = DBConnect(connection=connection)
     my_engine = windy_db.engine
     DeclarativeBase.metadata.create_all(my_engine)
+    rollups.DeclarativeBase.metadata.create_all(my_engine)
+    fingerprints.DeclarativeBase.metadata.create_all(my_engine)
     return my_engine
 
 
@@ -84,39 +88,51 @@ def get_tide_predictions_from_noaa():
     session_db = Session()
     stations_list = get_stations_from_db(session_db)
 
-    today = datetime.utcnow().replace(microsecond=0)
+    # The window starts at midnight, so that runs of the same day request
+    # byte-identical predictions and unchanged stations can be skipped
+    today = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
     # delta_past = timedelta(hours=1)
     delta = timedelta(days=PREDICTION_DEPTH)
     future = today + delta
+    begin_date = today.strftime("%Y%m%d %H:%M")
+    end_date = future.strftime("%Y%m%d %H:%M")
+    payloads = fingerprints.FingerprintStore(
+        session_db, 'predictions', '{}/{}'.format(begin_date, end_date))
 
     tides_by_stations = noaa_stations.get_data(
         stations_list,
-        begin_date=today.strftime("%Y%m%d %H:%M"),
-        end_date=future.strftime("%Y%m%d %H:%M"),
+        begin_date=begin_date,
+        end_date=end_date,
         product="predictions",
         datum="MLLW",
+        fingerprints=payloads,
         )
 
-    put_tide_predictions_to_db(session_db, tides_by_stations)
+    put_tide_predictions_to_db(session_db, tides_by_stations, today)
+    payloads.commit()
 
 
-def put_tide_predictions_to_db(session_db, tides_by_stations):
+def put_tide_predictions_to_db(session_db, tides_by_stations, window_begin=None):
 
-    today = datetime.utcnow().replace(microsecond=0)
-    session_db.query(PredictionsDb).filter(PredictionsDb.date_time <= today).delete(synchronize_session='fetch')
+    if window_begin is None:
+        window_begin = datetime.utcnow().replace(microsecond=0)
+    session_db.query(PredictionsDb).filter(PredictionsDb.date_time < window_begin).delete(synchronize_session='fetch')
     session_db.commit()
 
-        # put predictions to database
-    for date_time, row in tides_by_stations.iterrows():
-        new_pred = PredictionsDb(
-            station_id=row['station_id'],
-            date_time=date_time,
-            predicted_wl=row['predicted_wl'],
-            )
-        # Добавляем запись
-        session_db.add(new_pred)
+    if tides_by_stations.empty:
+        return
+
+    # put only new and revised predictions to database
+    predictions = dict(zip(
+        zip(tides_by_stations['station_id'].astype(int).tolist(),
+            tides_by_stations.index.to_pydatetime().tolist()),
+        tides_by_stations['predicted_wl'].astype(float).tolist(),
+        ))
+    revised = []
+    new_rows = fingerprints.write_changed_rows(session_db, PredictionsDb, 'predicted_wl', predictions, revised)
 
     session_db.commit()
+    rollups.update_rollups(session_db, PredictionsDb, 'predicted_wl', 'predictions', new_rows, revised)
 
 
 if __name__ == "__main__":
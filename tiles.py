@@ -0,0 +1,311 @@
+import hashlib
+import json
+import os
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import func
+from sqlalchemy.orm import sessionmaker
+
+import residuals
+from residuals import ResidualsDb
+from windy_bbox import StationDb, WaterLevelsDb
+
+
+TILES_DIR = 'tiles'
+EARTH_RADIUS_KM = 6371.0
+NEIGHBORS = 8
+IDW_POWER = 2
+MAX_DISTANCE_KM = 300.0  # cells farther from every station are nodata
+CHUNK_CELLS = 4096
+MAX_STALENESS = timedelta(hours=1)  # older station values are nodata
+KEEP_TILES = 240  # a day of 6-minute tiles per grid and field
+
+Grid = namedtuple('Grid', 'name lat_min lat_max lon_min lon_max step')
+
+GRIDS = [
+    Grid('conus', 24.0, 50.0, -125.0, -66.0, 0.1),
+    Grid('pacific', -15.0, 72.0, -180.0, -125.0, 0.25),
+]
+
+# Quantization of each field to uint8, 255 is nodata
+Field = namedtuple('Field', 'name low high dtype')
+FIELDS = {
+    'residual': Field('residual', -2.0, 2.0, 'uint8'),
+    'water_level': Field('water_level', -2.0, 8.0, 'float16'),
+}
+NODATA_UINT8 = 255
+
+
+def grid_shape(grid):
+    n_lat = int(round((grid.lat_max - grid.lat_min) / grid.step)) + 1
+    n_lon = int(round((grid.lon_max - grid.lon_min) / grid.step)) + 1
+    return n_lat, n_lon
+
+
+def grid_cells(grid):
+    """Latitudes and longitudes of the cell centers, row major."""
+    n_lat, n_lon = grid_shape(grid)
+    lats = grid.lat_min + grid.step * np.arange(n_lat)
+    lons = grid.lon_min + grid.step * np.arange(n_lon)
+    lon_grid, lat_grid = np.meshgrid(lons, lats)
+    return lat_grid.ravel(), lon_grid.ravel()
+
+
+def _unit_vectors(lats, lons):
+    lat = np.radians(lats)
+    lon = np.radians(lons)
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)],
+        axis=-1)
+
+
+def build_neighbor_index(grid, station_ids, lats, lons, k=NEIGHBORS):
+    """
+    The k nearest stations of every grid cell and their inverse distance
+    weights, computed once per grid and station set.
+    """
+    cell_lats, cell_lons = grid_cells(grid)
+    stations_xyz = _unit_vectors(np.asarray(lats), np.asarray(lons))
+    k = min(k, len(station_ids))
+
+    neighbors = np.empty((len(cell_lats), k), dtype=np.int32)
+    distances = np.empty((len(cell_lats), k), dtype=np.float32)
+    for start in range(0, len(cell_lats), CHUNK_CELLS):
+        stop = start + CHUNK_CELLS
+        cells_xyz = _unit_vectors(cell_lats[start:stop], cell_lons[start:stop])
+        cosine = np.clip(cells_xyz @ stations_xyz.T, -1.0, 1.0)
+        km = EARTH_RADIUS_KM * np.arccos(cosine)
+        nearest = np.argpartition(km, k - 1, axis=1)[:, :k]
+        neighbors[start:stop] = nearest
+        distances[start:stop] = np.take_along_axis(km, nearest, axis=1)
+
+    with np.errstate(divide='ignore'):
+        weights = 1.0 / np.maximum(distances, 1e-3) ** IDW_POWER
+    weights[distances > MAX_DISTANCE_KM] = 0.0
+
+    return {
+        'station_ids': np.asarray(station_ids, dtype=np.int64),
+        'neighbors': neighbors,
+        'weights': weights.astype(np.float32),
+    }
+
+
+def stations_digest(station_ids, lats, lons):
+    stations = np.stack([station_ids, lats, lons]).astype(np.float64)
+    return hashlib.sha1(stations.tobytes()).hexdigest()
+
+
+def load_neighbor_index(grid, station_ids, lats, lons):
+    """Neighbor index of the grid, rebuilt only when the stations change."""
+    path = os.path.join(TILES_DIR, grid.name, 'neighbors.npz')
+    digest = stations_digest(station_ids, lats, lons)
+    if os.path.exists(path):
+        stored = np.load(path)
+        if str(stored['digest']) == digest:
+            return {key: stored[key] for key in
+                    ('station_ids', 'neighbors', 'weights')}
+
+    index = build_neighbor_index(grid, station_ids, lats, lons)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, digest=digest, **index)
+    return index
+
+
+def cells_of_stations(index, positions):
+    """Cells where any of the stations at the given positions has weight."""
+    influenced = np.isin(index['neighbors'], positions) & (index['weights'] > 0)
+    return np.flatnonzero(influenced.any(axis=1))
+
+
+def interpolate(index, values, cells=None):
+    """Inverse distance weighted field of the station values."""
+    neighbors = index['neighbors']
+    weights = index['weights']
+    if cells is not None:
+        neighbors = neighbors[cells]
+        weights = weights[cells]
+    neighbor_values = values[neighbors]
+    valid = ~np.isnan(neighbor_values)
+    weights = np.where(valid, weights, 0.0)
+    total = weights.sum(axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        field = (weights * np.where(valid, neighbor_values, 0.0)).sum(axis=1) / total
+    field[total == 0] = np.nan
+    return field
+
+
+def quantize(field_values, field):
+    if field.dtype == 'float16':
+        return field_values.astype(np.float16)
+    scaled = (field_values - field.low) / (field.high - field.low) * 254
+    quantized = np.clip(np.round(scaled), 0, 254)
+    quantized[np.isnan(field_values)] = NODATA_UINT8
+    return quantized.astype(np.uint8)
+
+
+def tile_path(grid, field, date_time):
+    return os.path.join(TILES_DIR, grid.name, field.name,
+                        date_time.strftime('%Y%m%dT%H%M') + '.npy')
+
+
+def write_meta(grid, field):
+    path = os.path.join(TILES_DIR, grid.name, field.name, 'meta.json')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as meta:
+        json.dump({
+            'lat_min': grid.lat_min, 'lat_max': grid.lat_max,
+            'lon_min': grid.lon_min, 'lon_max': grid.lon_max,
+            'step': grid.step, 'shape': grid_shape(grid),
+            'dtype': field.dtype, 'low': field.low, 'high': field.high,
+            'nodata': NODATA_UINT8 if field.dtype == 'uint8' else 'nan',
+        }, meta)
+
+
+def list_tiles(grid, field):
+    """Tile file names of a grid and field, oldest first."""
+    directory = os.path.join(TILES_DIR, grid.name, field.name)
+    if not os.path.isdir(directory):
+        return []
+    return sorted(f for f in os.listdir(directory)
+                  if f.endswith('.npy') and not f.endswith('.stations.npy'))
+
+
+def stations_path(tile):
+    return tile[:-len('.npy')] + '.stations.npy'
+
+
+def previous_tile(grid, field, date_time):
+    """Path of the newest tile written before date_time, if any."""
+    name = date_time.strftime('%Y%m%dT%H%M') + '.npy'
+    older = [f for f in list_tiles(grid, field) if f < name]
+    if not older:
+        return None
+    return os.path.join(TILES_DIR, grid.name, field.name, older[-1])
+
+
+def prune_tiles(grid, field, keep=KEEP_TILES):
+    """Delete all but the newest tiles, mapped copies stay readable."""
+    directory = os.path.join(TILES_DIR, grid.name, field.name)
+    for name in list_tiles(grid, field)[:-keep]:
+        tile = os.path.join(directory, name)
+        os.remove(tile)
+        if os.path.exists(stations_path(tile)):
+            os.remove(stations_path(tile))
+
+
+def write_tile(grid, field, date_time, index, values):
+    """
+    Write the tile of one timestep as a memory-mappable .npy file.
+    Starting from the previous tile only the cells influenced by stations
+    whose value changed are interpolated again.
+
+    Both files are written under temporary names and moved in place,
+    the station values first, so readers mapping a published tile never
+    see it rewritten and every tile has its station values.
+    """
+    values = np.asarray(values, dtype=np.float32)
+    path = tile_path(grid, field, date_time)
+    prior = previous_tile(grid, field, date_time)
+    n_lat, n_lon = grid_shape(grid)
+    cells = None
+    if prior is not None and os.path.exists(stations_path(prior)):
+        prior_ids, prior_values = np.load(stations_path(prior))
+        same_layout = (np.array_equal(prior_ids, index['station_ids'])
+                       and np.load(prior, mmap_mode='r').shape == (n_lat, n_lon))
+        if same_layout:
+            changed = ~((prior_values == values)
+                        | (np.isnan(prior_values) & np.isnan(values)))
+            cells = cells_of_stations(index, np.flatnonzero(changed))
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tile = np.lib.format.open_memmap(
+        path + '.tmp', mode='w+', dtype=field.dtype, shape=(n_lat, n_lon))
+    if cells is None:
+        tile[:] = quantize(interpolate(index, values), field).reshape(n_lat, n_lon)
+    else:
+        tile[:] = np.load(prior, mmap_mode='r')
+        flat = tile.reshape(-1)
+        flat[cells] = quantize(interpolate(index, values, cells), field)
+    tile.flush()
+    del tile
+
+    with open(stations_path(path) + '.tmp', 'wb') as stations_file:
+        np.save(stations_file,
+                np.stack([index['station_ids'], values]).astype(np.float64))
+    os.replace(stations_path(path) + '.tmp', stations_path(path))
+    os.replace(path + '.tmp', path)
+    return path
+
+
+def latest_station_values(session_db, field_name, date_time):
+    """
+    Station id, latitude, longitude and value arrays of the newest value
+    of every station at or before date_time, within MAX_STALENESS.
+    """
+    stations = session_db.query(
+        StationDb.id, StationDb.latitude, StationDb.longitude,
+    ).order_by(StationDb.id).all()
+    station_ids = np.array([s[0] for s in stations], dtype=np.int64)
+    lats = np.array([float(s[1]) for s in stations])
+    lons = np.array([float(s[2]) for s in stations])
+
+    if field_name == 'residual':
+        model, column = ResidualsDb, ResidualsDb.residual
+    else:
+        model, column = WaterLevelsDb, WaterLevelsDb.water_level
+    # Stations report with different delays, take each one's newest value
+    newest = session_db.query(
+        model.station_id, func.max(model.date_time).label('date_time'),
+    ).filter(
+        model.date_time > date_time - MAX_STALENESS,
+        model.date_time <= date_time,
+    ).group_by(model.station_id).subquery()
+    rows = session_db.query(model.station_id, column).join(
+        newest,
+        (model.station_id == newest.c.station_id)
+        & (model.date_time == newest.c.date_time),
+    ).all()
+
+    values = np.full(len(station_ids), np.nan, dtype=np.float32)
+    if rows:
+        ids = np.array([r[0] for r in rows], dtype=np.int64)
+        vals = np.array([np.nan if r[1] is None else float(r[1]) for r in rows])
+        rank = np.minimum(np.searchsorted(station_ids, ids), len(station_ids) - 1)
+        found = station_ids[rank] == ids
+        values[rank[found]] = vals[found]
+    return station_ids, lats, lons, values
+
+
+def generate_tiles(session_db, date_time=None, field_name='residual', grids=GRIDS):
+    """Tiles of all grids for one timestep, the newest residual by default."""
+    if date_time is None:
+        # A station whose clock runs ahead must not move the timestep
+        date_time = session_db.query(func.max(ResidualsDb.date_time)).filter(
+            ResidualsDb.date_time <= datetime.utcnow()).scalar()
+        if date_time is None:
+            return []
+    field = FIELDS[field_name]
+    station_ids, lats, lons, values = latest_station_values(
+        session_db, field_name, date_time)
+
+    paths = []
+    for grid in grids:
+        index = load_neighbor_index(grid, station_ids, lats, lons)
+        write_meta(grid, field)
+        paths.append(write_tile(grid, field, date_time, index, values))
+        prune_tiles(grid, field)
+    return paths
+
+
+if __name__ == "__main__":
+
+    the_engine = residuals.open_db()
+    Session = sessionmaker(bind=the_engine)
+    session = Session()
+
+    started = datetime.utcnow()
+    for tile in generate_tiles(session):
+        print(tile)
+    print('done in {}'.format(datetime.utcnow() - started))
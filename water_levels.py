@@ -6,7 +6,10 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy import Column, ForeignKey, Integer, Numeric, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
-from noaa_stations import Station
+import fingerprints
+import noaa_stations
+import rollups
+import ring_buffer
 
 
 def open_db():
@@ -19,6 +22,7 @@ def open_db():
     windy_db = DBConnect(connection=connection)
     my_engine = windy_db.engine
     DeclarativeBase.metadata.create_all(my_engine)
+    rollups.DeclarativeBase.metadata.create_all(my_engine)
     return my_engine
 
 
@@ -90,42 +94,40 @@ def put_water_levels():
     Session = sessionmaker(bind=the_engine)
     session = Session()
     stations_list = get_stations_from_db(session)
-    # for every station from stations
-    is_first_print = 0
-    for station_row in stations_list:
-        station_id = station_row.id
-        station = Station(station_id)
-    #    get water level
-        tide_data = station.get_data(
-            begin_date=past.strftime("%Y%m%d %H:%M"),
-            end_date=today.strftime("%Y%m%d %H:%M"),
-            product="water_level",
-            # product="predictions",
-            datum="MLLW",
-            units="metric",
-            time_zone="gmt",
-            # interval='h',
-            application='Eugene_Mamontov',
-            )
-        if tide_data.empty:
-            continue
-
-        # put predictions to database
-        for date_time, row in tide_data.iterrows():
-            new_measure = WaterLevelsDb(
-                station_id=station_id,
-                date_time=date_time,
-                water_level=row['water_level'],
-                )
-            # Добавляем запись
-            session.add(new_measure)
-
-        print(tide_data.tail())
-        is_first_print += 1
-        if is_first_print >= 10:
-            break
+    # get water levels of all stations at once
+    tide_data = noaa_stations.get_data(
+        [station_row.id for station_row in stations_list],
+        begin_date=past.strftime("%Y%m%d %H:%M"),
+        end_date=today.strftime("%Y%m%d %H:%M"),
+        product="water_level",
+        # product="predictions",
+        datum="MLLW",
+        units="metric",
+        time_zone="gmt",
+        # interval='h',
+        application='Eugene_Mamontov',
+        )
+    if tide_data.empty:
+        return []
+    # NOAA gaps ("v": "") parse to NaN, MySQL cannot store them
+    tide_data = tide_data.dropna(subset=['water_level'])
+    if tide_data.empty:
+        return []
+
+    # put only new and revised measures to database
+    measures = dict(zip(
+        zip(tide_data['station_id'].astype(int).tolist(),
+            tide_data.index.to_pydatetime().tolist()),
+        tide_data['water_level'].astype(float).tolist(),
+        ))
+    revised = []
+    new_rows = fingerprints.write_changed_rows(session, WaterLevelsDb, 'water_level', measures, revised)
+    print(tide_data.tail())
 
     session.commit()
+    rollups.update_rollups(session, WaterLevelsDb, 'water_level', 'water_level', new_rows, revised)
+    ring_buffer.put_rows(session, new_rows)
+    return new_rows
 
 
 if __name__ == "__main__":
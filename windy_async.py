@@ -1,10 +1,12 @@
 import aiohttp
 import asyncio
+import json
 
-from noaa_stations import build_base_url
+import noaa_stations
+from fingerprints import payload_digest
 
 
-async def get_tide_async(base_url, stations_loc, tides_by_stations):
+async def get_tide_async(base_url, stations_loc, tides_by_stations, fingerprints=None):
     conc_req = 10
     async with aiohttp.ClientSession() as session:
         for i in range(conc_req):
@@ -13,8 +15,14 @@ async def get_tide_async(base_url, stations_loc, tides_by_stations):
             station_id = stations_loc.pop()
             url = build_station_url(base_url, station_id)
             async with session.get(url) as resp:
-                tide_row = await resp.json()
+                payload = await resp.read()
+                digest = payload_digest(payload)
+                # Skip payloads byte-identical to the stored ones before decoding
+                if fingerprints is not None and fingerprints.is_unchanged(station_id, digest):
+                    continue
+                tide_row = json.loads(payload)
                 tide_row['station_id'] = station_id
+                tide_row['digest'] = digest
                 tides_by_stations.append(tide_row)
 
 
@@ -25,12 +33,23 @@ def build_station_url(base_url, station_id):
 def get_data_from_noaa(
         begin_date,
         end_date,
-        stations_list
+        stations_list,
+        product="predictions",
+        datum="MLLW",
+        interval=None,
+        units="metric",
+        time_zone="gmt",
+        fingerprints=None,
 ):
 
-    base_url = build_base_url(
+    base_url = noaa_stations.build_base_url(
         begin_date,
         end_date,
+        product=product,
+        datum=datum,
+        interval=interval,
+        units=units,
+        time_zone=time_zone,
     )
     tides_by_stations = []
     stations_loc = stations_list.copy()
@@ -39,6 +58,6 @@ def get_data_from_noaa(
         if len(stations_loc) == 0:
             break
 
-        asyncio.run(get_tide_async(base_url, stations_loc, tides_by_stations))
+        asyncio.run(get_tide_async(base_url, stations_loc, tides_by_stations, fingerprints))
 
     return tides_by_stations
@@ -10,6 +10,13 @@ from sqlalchemy.orm import sessionmaker
 from sqlalchemy import Column, ForeignKey, Integer, Numeric, String, DateTime
 from sqlalchemy.ext.declarative import declarative_base
 
+import rollups
+import fingerprints
+import ring_buffer
+
+
+PREDICTION_DEPTH = 1  # hours of water levels fetched by every run
+
 
 def open_db():
     connection = {'user': 'malemute',
@@ -21,6 +28,8 @@ def open_db():
     windy_db = DBConnect(connection=connection)
     my_engine = windy_db.engine
     DeclarativeBase.metadata.create_all(my_engine)
+    rollups.DeclarativeBase.metadata.create_all(my_engine)
+    fingerprints.DeclarativeBase.metadata.create_all(my_engine)
     return my_engine
 
 
@@ -158,7 +167,9 @@ def get_water_levels_from_noaa():
     delta_past = timedelta(hours=PREDICTION_DEPTH)
     # delta = timedelta(days=PREDICTION_DEPTH)
     # future = today + delta
-    past = today - delta_past
+    # Align the window start to the hour, so that the previous hour is
+    # requested whole and its rows match their fingerprint once closed
+    past = (today - delta_past).replace(minute=0, second=0)
 
     noaa_url = build_query_url(
         begin_date=past.isoformat(),
@@ -173,10 +184,40 @@ def get_water_levels_from_noaa():
 
     tide_table = requests.get(noaa_url).text
 
-    put_water_levels_to_db(tide_table)
+    return put_water_levels_to_db(tide_table, skip_unchanged=True)
+
+
+def group_measure_rows(tide_measures_list):
+    """Group the SOS csv rows by station, skipping the header row."""
+    station_measures = {}
+    for measure_row in tide_measures_list[1:]:
+        if not measure_row:
+            continue
+        station_full = measure_row.split(',', 1)[0]
+        station_measures.setdefault(station_full, []).append(measure_row)
+    return station_measures
+
+
+def group_rows_by_hour(measure_rows):
+    """Split the csv rows of one station by the hour of their date_time."""
+    hour_rows = {}
+    for measure_row in measure_rows:
+        hour = measure_row.split(',')[4][:13]  # e.g. 2022-01-28T10
+        hour_rows.setdefault(hour, []).append(measure_row)
+    return hour_rows
+
+
+def parse_measure_rows(station_id, measure_rows):
+    """{(station_id, date_time): water_level} of one station's csv rows."""
+    measures = {}
+    for measure_row in measure_rows:
+        measure = measure_row.split(',')
+        date_time = datetime.fromisoformat(measure[4][:-1])
+        measures[(station_id, date_time)] = float(measure[5])
+    return measures
 
 
-def put_water_levels_to_db(tide_table):
+def put_water_levels_to_db(tide_table, skip_unchanged=False):
 
     # open database
     the_engine = open_db()
@@ -184,29 +225,43 @@ def put_water_levels_to_db(tide_table):
     session = Session()
 
     tide_measures_list = tide_table.split('\n')
-
-    for measure_row in tide_measures_list[1:]:
-        if not measure_row:
-            continue
-        measure = measure_row.split(',')
-        station_full = measure[0]
-        station_id = station_full.split(':')[-1]
-
-        # put measure to database
-        new_measure_in_db = WaterLevelsDb(
-                station_id=int(station_id),
-                date_time=datetime.fromisoformat(measure[4][:-1]),
-                water_level=float(measure[5]),
-                )
-        # Добавляем запись
-        session.add(new_measure_in_db)
-
+    station_measures = group_measure_rows(tide_measures_list)
+
+    # Fingerprint every station-hour of rows, a closed hour is skipped by
+    # all later runs until a late or verified row changes it
+    station_hours = {
+        station_full: group_rows_by_hour(measure_rows)
+        for station_full, measure_rows in station_measures.items()
+    }
+    payloads = None
+    if skip_unchanged:
+        hours = sorted({hour for hour_rows in station_hours.values() for hour in hour_rows})
+        payloads = fingerprints.FingerprintStore(session, 'water_level', hours)
+
+    measures = {}
+    for station_full, hour_rows in station_hours.items():
+        station_id = int(station_full.split(':')[-1])
+        for hour, measure_rows in hour_rows.items():
+            if payloads is not None:
+                digest = fingerprints.payload_digest('\n'.join(measure_rows))
+                if payloads.is_unchanged(station_id, digest, hour):
+                    continue
+                payloads.remember(station_id, digest, hour)
+            measures.update(parse_measure_rows(station_id, measure_rows))
+
+    # put only new and revised measures to database
+    revised = []
+    new_rows = fingerprints.write_changed_rows(session, WaterLevelsDb, 'water_level', measures, revised)
     session.commit()
+    if payloads is not None:
+        payloads.commit()
+    rollups.update_rollups(session, WaterLevelsDb, 'water_level', 'water_level', new_rows, revised)
+    ring_buffer.put_rows(session, new_rows)
     print(tide_measures_list[-5:])
 
+    return new_rows
 
-if __name__ == "__main__":
 
-    PREDICTION_DEPTH = 1
+if __name__ == "__main__":
 
     get_water_levels_from_noaa()